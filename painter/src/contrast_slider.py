@@ -36,8 +36,12 @@ class ContrastSlider(QtWidgets.QWidget):
         self.initUI()
 
     def update_range(self, img):
-        min_hu = np.min(img)
-        max_hu = np.max(img)
+        # the full-volume min/max scan is the expensive part; callers
+        # that want it off the GUI thread compute it themselves and
+        # call apply_range with the result.
+        self.apply_range(np.min(img), np.max(img))
+
+    def apply_range(self, min_hu, max_hu):
         self.hu_range = [min_hu, max_hu]
         self.min_slider.setMinimum(self.hu_range[0])
         self.min_slider.setMaximum(self.hu_range[1])
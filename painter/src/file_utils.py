@@ -20,6 +20,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
 from os.path import splitext
 import filecmp
+import hashlib
+import queue
+import threading
 import numpy as np
 from skimage.io import imread
 import nibabel as nib
@@ -43,15 +46,16 @@ def penultimate_fname_with_segmentation(fnames, seg_dir):
     if not len(seg_dirs):
         seg_dirs = [seg_dir]
     
-    seg_fnames = []
+    # set so the membership test below is O(1) rather than a scan
+    # of every segmentation per fname.
+    seg_fnames = set()
 
     for seg_dir in seg_dirs:
-        seg_fnames += os.listdir(seg_dir)
+        seg_fnames.update(os.listdir(seg_dir))
 
     for fname in fnames:
        #=  fname.replace('.nrrd', '.nii.gz')
-        if fname.endswith(
-            ('.dcm', '.dicom', '.sr', '.DCM', '.DICOM', '.SR')):
+        if im_utils.is_dicom(fname):
             base_fname = fname.replace('.dcm', '.nii.gz')
         else:
             base_fname = fname.replace('.nrrd', '.nii.gz')
@@ -61,12 +65,20 @@ def penultimate_fname_with_segmentation(fnames, seg_dir):
             last_fname = fname
     return pen_fname
 
-def get_recursive_files(input_path):
+def get_recursive_files(input_path, exts=None):
+    """ All file paths below input_path, deepest directories first.
+        os.scandir is used so the is_dir check comes from the dirent
+        info already returned by the OS, avoiding a stat per entry.
+        exts (optional) filters to the given extensions during the walk. """
     filenames = []
-    path = Path(input_path)
-    for p in path.rglob("*"):
-        if os.path.isdir(str(p)) is False:
-            filenames.append(p._str)
+    stack = [str(input_path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif exts is None or entry.name.endswith(exts):
+                    filenames.append(entry.path)
     return filenames
 
 
@@ -76,8 +88,7 @@ def get_annot_path(fname, train_dir, val_dir):
     train or val annot dirs.
     Otherwise return None
     """
-    if fname.endswith(
-        ('.dcm', '.dicom', '.sr', '.DCM', '.DICOM', '.SR')):
+    if im_utils.is_dicom(fname):
       #  fname = fname.replace('.dcm', '.nii.gz')
         fname = fname.replace('.dcm', '.nii.gz').replace('.DCM', '.nii.gz')
 
@@ -92,43 +103,201 @@ def get_annot_path(fname, train_dir, val_dir):
     return None
 
 
+def count_annots(annot_dir, cap=None):
+    """ Count annotation files below annot_dir, stopping early once
+        cap is reached (the caller only needs to know 'at least cap'). """
+    count = 0
+    stack = [str(annot_dir)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(('.png', '.npy', '.gz')):
+                    count += 1
+                    if cap is not None and count >= cap:
+                        return count
+    return count
+
+
 def get_new_annot_target_dir(train_annot_dir, val_annot_dir):
     """ Should we add new annotations to train or validation data? """
-    #train_annots = os.listdir(train_annot_dir)
-    #val_annots = os.listdir(val_annot_dir)
-    train_annots = get_recursive_files(train_annot_dir)
-    val_annots = get_recursive_files(val_annot_dir)
-    
-    
-    train_annots = [f for f in train_annots if (splitext(f)[1] in ['.png', '.npy', '.gz'])]
-    val_annots = [f for f in val_annots if (splitext(f)[1] in ['.png', '.npy', '.gz'])]
-
-    num_train_annots = len(train_annots)
-    num_val_annots = len(val_annots)
-    
-    if num_train_annots == 0 and num_val_annots == 0:
-        # save in train directory first 
-        return train_annot_dir
-    # otherwise aim to get at least one annotation in train and validation.
-    if num_train_annots == 0 and num_val_annots > 0:
+    # the decision only needs 'is train empty?', 'is val empty?' and
+    # 'train >= 5x val', so the walks stop as soon as that is known
+    # rather than enumerating every annotation.
+    if count_annots(train_annot_dir, cap=1) == 0:
+        # save in train directory first (and also if only val has files).
         return train_annot_dir
-    if num_train_annots > 0 and num_val_annots == 0:
+    # otherwise aim to get at least one annotation in train and validation.
+    num_val_annots = count_annots(val_annot_dir)
+    if num_val_annots == 0:
         return val_annot_dir
     # then only add files to validation if there is at least 5x in train
-    if num_train_annots >= (num_val_annots * 5):
+    if count_annots(train_annot_dir, cap=num_val_annots * 5) >= (num_val_annots * 5):
         return val_annot_dir
     return train_annot_dir
 
 
+def annot_digest(annot_data):
+    """ Digest of the packed annotation bits.
+        Stored in a sidecar next to each annotation so an unchanged save
+        can be detected without re-loading the whole previous annotation. """
+    packed = np.packbits(annot_data.astype(bool, copy=False))
+    return hashlib.blake2b(packed.tobytes(), digest_size=16).hexdigest()
+
+
+def digest_path_for(annot_path):
+    # hidden name, so the trainer's annotation listing (which skips
+    # hidden files) never picks a sidecar up as an annotation.
+    return os.path.join(os.path.dirname(str(annot_path)),
+                        '.' + os.path.basename(str(annot_path)) + '.blake2')
+
+
+def read_annot_digest(annot_path):
+    """ return the cached digest for annot_path, or None if missing """
+    try:
+        with open(digest_path_for(annot_path)) as digest_file:
+            return digest_file.read().strip()
+    except OSError:
+        return None
+
+
+def write_annot_digest(annot_path, digest):
+    with open(digest_path_for(annot_path), 'w') as digest_file:
+        digest_file.write(digest)
+
+
+def remove_annot_digest(annot_path):
+    try:
+        os.remove(digest_path_for(annot_path))
+    except OSError:
+        pass
+
+
+class AnnotWriter:
+    """ Writes annotation NIfTI files from a single background thread so
+        saving doesn't block the UI for large volumes. Each file is first
+        written under a .tmp_ name and then moved into place with
+        os.replace, so a partially written annotation is never visible.
+        Successive writes to the same path are coalesced - only the most
+        recently queued data is written. """
+
+    def __init__(self):
+        self.pending = {} # final path -> (nifti image, digest)
+        self.pending_lock = threading.Lock()
+        self.write_queue = queue.Queue()
+        # first background write failure, re-raised on the next save.
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, img, annot_path, digest):
+        error = self.error
+        if error is not None:
+            # a previous background write failed (disk full,
+            # permissions..) - surface it on the UI thread, as a direct
+            # save would have.
+            self.error = None
+            raise error
+        with self.pending_lock:
+            self.pending[annot_path] = (img, digest)
+        self.write_queue.put(annot_path)
+
+    def pending_annot_data(self, annot_path):
+        """ data for a queued (not yet written) annotation, or None.
+            Loads must see queued writes, otherwise navigating away and
+            quickly back would show the pre-edit file on disk. """
+        with self.pending_lock:
+            item = self.pending.get(annot_path)
+        if item is None:
+            return None
+        img, _ = item
+        # copied so edits don't mutate the queued data mid-write.
+        return np.asanyarray(img.dataobj).copy()
+
+    def flush(self):
+        """ Block until every queued write has been attempted. """
+        self.write_queue.join()
+        error = self.error
+        if error is not None:
+            self.error = None
+            raise error
+
+    def write_loop(self):
+        while True:
+            annot_path = self.write_queue.get()
+            try:
+                with self.pending_lock:
+                    item = self.pending.get(annot_path)
+                if item is None:
+                    # a newer write for this path was already flushed.
+                    continue
+                img, digest = item
+                tmp_annot_path = os.path.join(os.path.dirname(annot_path),
+                                              '.tmp_' + os.path.basename(annot_path))
+                img.to_filename(tmp_annot_path)
+                os.replace(tmp_annot_path, annot_path)
+                write_annot_digest(annot_path, digest)
+                with self.pending_lock:
+                    # entries stay visible to pending_annot_data until
+                    # on disk; drop only if no newer write arrived.
+                    if self.pending.get(annot_path) is item:
+                        del self.pending[annot_path]
+            except Exception as ex:
+                # keep the thread alive so later saves are still
+                # attempted, and surface the failure on the next save
+                # rather than dying with the queue still accepting work.
+                self.error = ex
+            finally:
+                self.write_queue.task_done()
+
+
+annot_writer = None
+
+def get_annot_writer():
+    global annot_writer
+    if annot_writer is None:
+        annot_writer = AnnotWriter()
+    return annot_writer
+
+
+def pending_annot_data(annot_path):
+    """ see AnnotWriter.pending_annot_data. None if nothing queued. """
+    if annot_writer is None or annot_path is None:
+        return None
+    return annot_writer.pending_annot_data(annot_path)
+
+
+def flush_annot_writer():
+    """ Block until queued annotation writes hit disk. Called on exit
+        so a save enqueued just before closing is not lost when the
+        daemon thread dies with the process. """
+    if annot_writer is not None:
+        annot_writer.flush()
+
+
 def maybe_save_annotation_3d(image_data_shape, annot_data, annot_path,
                              fname, train_annot_dir, val_annot_dir, log):
     annot_data = annot_data.astype(np.byte)
     # if there is an existing annotation.
     if annot_path:
-        existing_annot = im_utils.load_annot(annot_path,
-                                             image_data_shape).astype(np.byte)
+        new_digest = annot_digest(annot_data)
+        cached_digest = read_annot_digest(annot_path)
+        if cached_digest == new_digest:
+            # digests match so the annotation is unchanged. Skip the
+            # full disk read and array compare on this common path.
+            annot_unchanged = True
+        else:
+            # no digest cached (or a mismatch) so fall back to loading
+            # the previous annotation and comparing in full.
+            existing_annot = im_utils.load_annot(annot_path,
+                                                 image_data_shape).astype(np.byte)
+            annot_unchanged = np.array_equal(annot_data, existing_annot)
+            if annot_unchanged and cached_digest is None:
+                # cache for next time so the load can be skipped.
+                write_annot_digest(annot_path, new_digest)
         # and the annot we are saving is different.
-        if not np.array_equal(annot_data, existing_annot):
+        if not annot_unchanged:
             # Then we must over-write the previously saved annoation.
             # The user is performing an edit, possibly correcting an error.
             # First save to project folder as temp file.
@@ -136,11 +305,12 @@ def maybe_save_annotation_3d(image_data_shape, annot_data, annot_path,
             if np.sum(annot_data) == 0:
                 log(f'maybe_save_annot,{fname},remove existing annotation as new data is empty')
                 os.remove(annot_path)
+                remove_annot_digest(annot_path)
             else:
                 # otherwise update the data.
                 log(f'maybe_save_annot,{fname},updated existing data')
                 img = nib.Nifti1Image(annot_data, np.eye(4))
-                img.to_filename(annot_path)
+                get_annot_writer().enqueue(img, annot_path, new_digest)
     else:
         # if there is not an existing annotation
         # and the annotation has some content
@@ -148,18 +318,15 @@ def maybe_save_annotation_3d(image_data_shape, annot_data, annot_path,
             log(f'maybe_save_annot,{fname},create new')
             # then find the best place to put it based on current counts.
             annot_dir = get_new_annot_target_dir(train_annot_dir, val_annot_dir)
-            # files starting with . are not used in training.
-            tmp_annot_path = os.path.join(annot_dir, '.tmp_' + fname)
-            dir_to_create = os.path.dirname(tmp_annot_path)
-            Path(dir_to_create).mkdir(parents=True, exist_ok=True)
             annot_path = os.path.join(annot_dir, fname)
             dir_to_create = os.path.dirname(annot_path)
             Path(dir_to_create).mkdir(parents=True, exist_ok=True)
-            
+
             img = nib.Nifti1Image(annot_data, np.eye(4))
-            img.to_filename(tmp_annot_path) 
-            # rename after finished saving to avoid error with loading partially saved annotation.
-            os.rename(tmp_annot_path, annot_path)
+            # the writer thread saves to a .tmp_ file (files starting with .
+            # are not used in training) and renames once finished, to avoid
+            # an error with loading a partially saved annotation.
+            get_annot_writer().enqueue(img, annot_path, annot_digest(annot_data))
         else:
             # if the annotation did not have content.
             # and there was not an existing annotation
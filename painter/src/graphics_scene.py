@@ -81,6 +81,8 @@ class GraphicsScene(QtWidgets.QGraphicsScene):
                         message = f"{removed_count} foreground regions and {holes} holes were removed"
                         self.parent.parent.info_label.setText(message)
                     self.parent.parent.annot_data = new_annot
+                    self.parent.parent._annot_dirty = True
+                    im_utils.invalidate_label_cache()
                     self.parent.parent.update_viewer_annot_slice()
                     self.parent.parent.update_viewer_outline()
 
@@ -27,13 +27,15 @@ from skimage import color
 from skimage.io import imread, imsave
 from skimage import img_as_ubyte
 from skimage.transform import resize
-from skimage.measure import label
-from skimage.morphology import binary_dilation, remove_small_holes
+from skimage.morphology import remove_small_holes
 from PIL import Image
 from PyQt5 import QtGui
 import qimage2ndarray
 import nibabel as nib
 from scipy.ndimage import binary_fill_holes
+from scipy.ndimage import label as ndimage_label
+from scipy.ndimage import generate_binary_structure
+from scipy.ndimage import find_objects
 from skimage.segmentation import flood
 import nrrd
 import SimpleITK as sitk
@@ -42,12 +44,30 @@ from scipy.ndimage import zoom
 import pandas as pd
 import psycopg2
 
+# extensions are checked once per file in directory-scan and load loops,
+# so look up a single lowered splitext result instead of re-running a
+# multi-way endswith against upper and lower case variants each time.
+DICOM_EXTS = frozenset({'.dcm', '.dicom', '.sr'})
+
+
+# faces and edges (18-connectivity): equivalent to skimage's
+# connectivity=2 labelling on 3D input, which the region labelling
+# used previously.
+STRUCT_18 = generate_binary_structure(3, 2)
+# full 3x3x3 structuring element (26-connectivity) for the hole count,
+# where full connectivity applied previously.
+STRUCT_26 = generate_binary_structure(3, 3)
+
+
+def is_dicom(fname):
+    return os.path.splitext(fname)[1].lower() in DICOM_EXTS
+
+
+IMAGE_EXTS = frozenset({'.npy', '.gz', '.nrrd', '.dicom', '.dcm', '.sr'})
+
+
 def is_image(fname):
-    extensions = {
-        '.npy', 'gz', 'nrrd', '.dicom',
-        '.dcm', '.DCM', '.DICOM', '.sr', '.SR'
-        }
-    return any(fname.lower().endswith(ext) for ext in extensions)
+    return os.path.splitext(fname)[1].lower() in IMAGE_EXTS
 
 
 def getDataFromDatabase(sql_config):
@@ -70,12 +90,20 @@ def getDataFromDatabase(sql_config):
     return df['DcmPathFlatten'].tolist()
 
 
-def get_recursive_files(input_path):
+def get_recursive_files(input_path, exts=None):
+    """ All file paths below input_path, deepest directories first.
+        os.scandir is used so the is_dir check comes from the dirent
+        info already returned by the OS, avoiding a stat per entry.
+        exts (optional) filters to the given extensions during the walk. """
     filenames = []
-    path = Path(input_path)
-    for p in path.rglob("*"):
-        if os.path.isdir(str(p)) is False:
-            filenames.append(p._str)
+    stack = [str(input_path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif exts is None or entry.name.endswith(exts):
+                    filenames.append(entry.path)
     return filenames
 
 
@@ -99,34 +127,79 @@ def pad_image(image, pad_size):
     return image
 
 
-def load_image(image_path):
+def load_image(image_path, slab=None):
+    """ Load the image volume at image_path.
+        slab (optional slice) restricts the read to a z-range so that
+        only the bytes for those slices are fetched/decoded rather than
+        the whole volume. """
     if image_path.endswith('.npy'):
-        return np.load(image_path, mmap_mode='c')
-    elif image_path.endswith('.nii.gz'):
-        image = nib.load(image_path)
-        image = np.array(image.dataobj)
+        image = np.load(image_path, mmap_mode='c')
+        if slab is not None:
+            # the memory map only pages in what is indexed.
+            image = image[slab]
+        return image
+    elif image_path.endswith(('.nii.gz', '.nii')):
+        image = nib.load(image_path, mmap=True)
+        if slab is not None:
+            # index the proxy so nibabel reads just the requested slab.
+            # note the z-axis is last in nibabel's ordering.
+            image = np.asanyarray(image.dataobj[:, :, slab])
+        else:
+            # for uncompressed unscaled files asanyarray gives back
+            # nibabel's memmap, so slices page in on demand. .nii.gz
+            # still decompresses fully here.
+            image = np.asanyarray(image.dataobj)
     elif image_path.endswith('.nrrd'):
         image, header = nrrd.read(image_path)
-    elif image_path.endswith(('.dicom', '.DICOM', '.dcm',
-                              '.DCM',  '.sr', '.SR')):
-        image = sitk.ReadImage(image_path)
+        if slab is not None:
+            image = image[slab]
+    elif is_dicom(image_path):
+        if slab is not None:
+            # ImageFileReader can decode a sub-region, so a slab read
+            # costs O(slices requested) rather than O(volume).
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(image_path)
+            reader.ReadImageInformation()
+            extract_size = list(reader.GetSize())
+            extract_size[2] = slab.stop - slab.start
+            reader.SetExtractIndex([0, 0, slab.start])
+            reader.SetExtractSize(extract_size)
+            image = reader.Execute()
+        else:
+            image = sitk.ReadImage(image_path)
         image = sitk.GetArrayFromImage(image)
        # print('image shape loaded (dcm)', image.shape)
     else:
         raise Exception(f"Unhandled file ending {image_path}")
-    image = image.astype(np.int)
+    # scanner data is at most 16 bit, so avoid holding an int64 copy
+    # (8 bytes per voxel) for the whole session. int32 rather than
+    # int16 as unsigned 16 bit data (common for CT stored without
+    # rescale) exceeds the int16 range and would wrap. norm_slice
+    # widens to float32 per slice when displaying.
+    if image.dtype not in (np.int16, np.int32, np.float32):
+        image = image.astype(np.int32, copy=False)
     return image
 
-def load_annot(annot_path, img_data_shape):
-    if annot_path.endswith(('.dicom', '.DICOM', '.dcm',
-                            '.DCM',  '.sr', '.SR')):
+def load_annot(annot_path, img_data_shape, lazy=False):
+    if annot_path.endswith('.npy'):
+        # memory-map as load_image does; copy-on-write keeps edits
+        # in memory while repeat reads come from the page cache.
+        return np.load(annot_path, mmap_mode='c')
+    if is_dicom(annot_path):
         image = sitk.ReadImage(annot_path)
         annot_data = sitk.GetArrayFromImage(image)
         annot_data = np.array(annot_data, dtype=bool)
         print('annot data shape', annot_data.shape)
-        
+
     else:
         annot_image = nib.load(annot_path)
+        if lazy:
+            # return the nibabel ArrayProxy so get_slice can read just the
+            # required slab from disk rather than decompressing everything.
+            # Note: .nii.gz forces a full decompress on first access, so for
+            # true lazy slicing the file should be stored uncompressed (.nii).
+            # bool conversion is left to the caller (per slice).
+            return annot_image.dataobj
         annot_data = np.array(annot_image.dataobj, dtype=bool)
   #      annot_data = np.rot90(annot_data, k=3)
       # print('annot data shape before permutation', annot_data.shape)
@@ -136,40 +209,71 @@ def load_annot(annot_path, img_data_shape):
     return annot_data
 
 
-def load_seg(seg_path):
-    if seg_path.endswith(('.dicom', '.DICOM', '.dcm',
-                            '.DCM',  '.sr', '.SR')):
+def load_seg(seg_path, lazy=False):
+    if seg_path.endswith('.npy'):
+        return np.load(seg_path, mmap_mode='c')
+    if is_dicom(seg_path):
         image = sitk.ReadImage(seg_path)
         seg_data = sitk.GetArrayFromImage(image)
        # seg_data = resizeVolume(seg_data, (128, 128))
         seg_data = np.array(seg_data, dtype=bool)
         print('seg data shape', seg_data.shape)
 
-        
+
     else:
         seg_image = nib.load(seg_path)
-        seg_data = np.array(seg_image.dataobj, dtype=bool)
+        if lazy:
+            # ArrayProxy (see load_annot). get_slice indexes it directly so
+            # only the viewed slab is read from disk.
+            seg_data = seg_image.dataobj
+        else:
+            seg_data = np.array(seg_image.dataobj, dtype=bool)
     #    seg_data = np.rot90(seg_data, k=3)
-        print('seg_data shape before per', seg_data.shape)
+            print('seg_data shape before per', seg_data.shape)
        # seg_data = np.moveaxis(seg_data, -1, 0) # depth moved to beginning
-        print('seg_data shape', seg_data.shape)
+            print('seg_data shape', seg_data.shape)
     # This issue may be related to file system issues.
     assert  len(seg_data.shape) == 3, f"seg shape is {seg_data.shape} for {seg_path}"
     return seg_data
 
 
 def norm_slice(img, min_v, max_v, brightness_percent):
-    if img.dtype != np.float32:
-        img = img.astype(np.float32)
-    bright_v = (brightness_percent / 100)
-    img[img < min_v] = min_v
-    img[img > max_v] = max_v
+    """ normalize a slice for viewing, returning uint8 (0-255).
+        clip, shift and scale are fused in-place so the slice is read
+        once and a single output buffer is allocated, rather than a
+        separate pass (and temporary) per operation. """
+    bright_v = brightness_percent / 100
+    # the contrast sliders can be set equal; everything clips to one
+    # level then, so any non-zero range gives the same output.
+    v_range = max(max_v - min_v, 1)
+    scale = (255.0 * bright_v) / v_range
+    img = np.clip(img, min_v, max_v).astype(np.float32)
     img -= min_v
-    img /= (max_v - min_v)
-    img *= bright_v
-    img[img > 1] = 1.0
-    img *= 255
-    return img
+    img *= scale
+    np.clip(img, 0, 255, out=img)
+    return img.astype(np.uint8)
+
+
+def rgba_to_pixmap(np_rgb):
+    """ convert a uint8 RGBA array to a QPixmap.
+        The QImage just wraps the numpy buffer (no per-pixel conversion
+        as in qimage2ndarray) and QPixmap.fromImage makes the single
+        unavoidable copy, so the buffer doesn't need to outlive us. """
+    height, width = np_rgb.shape[0], np_rgb.shape[1]
+    np_rgb = np.ascontiguousarray(np_rgb)
+    q_image = QtGui.QImage(np_rgb.data, width, height, 4 * width,
+                           QtGui.QImage.Format_RGBA8888)
+    return QtGui.QPixmap.fromImage(q_image)
+
+
+def gray_to_pixmap(gray):
+    """ convert a uint8 grayscale array to a QPixmap, wrapping the
+        buffer directly as rgba_to_pixmap does. The stride is passed
+        explicitly as Qt assumes 32-bit aligned rows otherwise. """
+    gray = np.ascontiguousarray(gray)
+    q_image = QtGui.QImage(gray.data, gray.shape[1], gray.shape[0],
+                           gray.strides[0], QtGui.QImage.Format_Grayscale8)
+    return QtGui.QPixmap.fromImage(q_image)
 
 
 def annot_slice_to_pixmap(slice_np):
@@ -177,39 +281,52 @@ def annot_slice_to_pixmap(slice_np):
         to a PyQt5 pixmap object """
     # for now fg and bg colors are hard coded.
     # later we plan to let the user specify these in the user interface.
-    np_rgb = np.zeros((slice_np.shape[1], slice_np.shape[2], 4))
-    np_rgb[:, :, 1] = slice_np[0] * 255 # green is bg
-    np_rgb[:, :, 0] = slice_np[1] * 255 # red is fg
-    np_rgb[:, :, 3] = np.sum(slice_np, axis=0) * 180 # alpha is defined
-    q_image = qimage2ndarray.array2qimage(np_rgb)
-    return QtGui.QPixmap.fromImage(q_image)
+    bg = slice_np[0] > 0
+    fg = slice_np[1] > 0
+    np_rgb = np.zeros((slice_np.shape[1], slice_np.shape[2], 4), dtype=np.uint8)
+    np_rgb[:, :, 1] = bg.astype(np.uint8) * 255 # green is bg
+    np_rgb[:, :, 0] = fg.astype(np.uint8) * 255 # red is fg
+    np_rgb[:, :, 3] = (bg | fg).astype(np.uint8) * 180 # alpha is defined
+    return rgba_to_pixmap(np_rgb)
 
 
 def get_outline_pixmap(seg_slice, annot_slice):
-    seg_map = (seg_slice > 0).astype(np.int)
-    annot_plus = (annot_slice[1] > 0).astype(np.int)
-    annot_minus = (annot_slice[0] > 0).astype(np.int)
+    # boolean masks: fg/bg annotation are mutually exclusive, as are
+    # seg > 0 and seg < 0, so the or/and-not logic matches the old
+    # int arithmetic without the int64 temporaries.
+    seg_map = seg_slice > 0
+    annot_plus = annot_slice[1] > 0
+    annot_minus = annot_slice[0] > 0
 
     # remove anything where seg is less than 0 as this is outside of the box
-    seg_minus = (seg_slice < 0).astype(np.int)
-    mask = ((((seg_map + annot_plus) - annot_minus) - seg_minus) > 0)
-    dilated = binary_dilation(mask)
-    outline = dilated.astype(np.int) - mask.astype(np.int)
-    np_rgb = np.zeros((outline.shape[0], outline.shape[1], 4))
-    np_rgb[outline > 0] = [255, 255, 0, 180]
-    q_image = qimage2ndarray.array2qimage(np_rgb)
-    return QtGui.QPixmap.fromImage(q_image)
+    seg_minus = seg_slice < 0
+    mask = (seg_map | annot_plus) & ~annot_minus & ~seg_minus
+    # 1-pixel outline: pixels outside the mask with a 4-connected
+    # neighbour inside it. Shift-and-or over the boolean slice matches
+    # what dilate-then-subtract produced, without the generic
+    # structuring-element machinery.
+    neighbours = np.zeros_like(mask)
+    neighbours[1:] |= mask[:-1]
+    neighbours[:-1] |= mask[1:]
+    neighbours[:, 1:] |= mask[:, :-1]
+    neighbours[:, :-1] |= mask[:, 1:]
+    outline = neighbours & ~mask
+    np_rgb = np.zeros((outline.shape[0], outline.shape[1], 4), dtype=np.uint8)
+    np_rgb[outline] = (255, 255, 0, 180)
+    return rgba_to_pixmap(np_rgb)
 
 
 def seg_slice_to_pixmap(slice_np):
     """ convert slice from the numpy segmentation data
         to a PyQt5 pixmap object """
-    np_rgb = np.zeros((slice_np.shape[0], slice_np.shape[1], 4))
-    np_rgb[slice_np > 0] = [0, 255, 255, 180]
-    q_image = qimage2ndarray.array2qimage(np_rgb)
-    return QtGui.QPixmap.fromImage(q_image)
+    np_rgb = np.zeros((slice_np.shape[0], slice_np.shape[1], 4), dtype=np.uint8)
+    np_rgb[slice_np > 0] = (0, 255, 255, 180)
+    return rgba_to_pixmap(np_rgb)
 
 def get_slice(volume, slice_idx, mode):
+    # volume may be a numpy array or a nibabel ArrayProxy (see load_annot /
+    # load_seg with lazy=True). Indexing the proxy makes nibabel read just
+    # the requested slab from disk instead of the full volume.
     if mode == 'axial':
         if len(volume.shape) > 3:
             slice_idx = (volume.shape[1] - slice_idx) - 1
@@ -261,14 +378,61 @@ def store_annot_slice(annot_pixmap, annot_data, slice_idx, mode):
     return annot_data
 
 
-def get_num_regions(seg_data, annot_data):
-    seg_map = (seg_data > 0).astype(np.int)
-    annot_plus = (annot_data[1] > 0).astype(np.int)
-    annot_minus = (annot_data[0] > 0).astype(np.int)
+# most recent labelling, shared between get_num_regions and
+# restrict_to_regions_containing_points. In the typical UI flow the
+# region count is requested right before restricting to a region, so
+# without this the full-volume labelling would run twice back to back.
+# Painting mutates annot_data in place, so the callers that modify it
+# must call invalidate_label_cache (alongside setting _annot_dirty).
+_label_cache = {'key': None, 'corrected': None, 'labelled': None,
+                'num_regions': None}
+
+
+def invalidate_label_cache():
+    """ Drop the cached labelling. Called whenever the annotation (or
+        segmentation) data is modified, as in-place edits leave the
+        cache key unchanged. """
+    _label_cache['key'] = None
+
+
+def _corrected_and_labelled(seg_data, annot_data):
+    key = (id(seg_data), id(annot_data), seg_data.shape)
+    if _label_cache['key'] == key:
+        return (_label_cache['corrected'], _label_cache['labelled'],
+                _label_cache['num_regions'])
+    # boolean masks rather than int arrays avoid three full-volume
+    # int64 temporaries (8 bytes per voxel each).
+    seg_map = seg_data > 0
+    annot_plus = annot_data[1] > 0
+    annot_minus = annot_data[0] > 0
     # remove anything where seg is less than 0 as this is outside of the box
-    corrected = (((seg_map + annot_plus) - annot_minus) > 0)
-    labelled = label(corrected, connectivity=2)
-    return len(np.unique(labelled)) - 1 # don't consider background a region.
+    corrected = (seg_map & annot_plus) | ((seg_map | annot_plus) & ~annot_minus)
+    # label only the tight bounding box of the foreground - everything
+    # outside it is background and would only add scan time. The axis
+    # projections cost three cheap passes and typically shrink the
+    # labelled region by one to two orders of magnitude.
+    labelled = np.zeros(corrected.shape, dtype=np.int32)
+    z_any = corrected.any(axis=(1, 2))
+    if z_any.any():
+        y_any = corrected.any(axis=(0, 2))
+        x_any = corrected.any(axis=(0, 1))
+        z0, z1 = np.flatnonzero(z_any)[[0, -1]]
+        y0, y1 = np.flatnonzero(y_any)[[0, -1]]
+        x0, x1 = np.flatnonzero(x_any)[[0, -1]]
+        crop = corrected[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1]
+        crop_labelled, num_regions = ndimage_label(crop, STRUCT_18)
+        labelled[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1] = crop_labelled
+    else:
+        num_regions = 0
+    _label_cache.update(key=key, corrected=corrected, labelled=labelled,
+                        num_regions=num_regions)
+    return corrected, labelled, num_regions
+
+
+def get_num_regions(seg_data, annot_data):
+    # ndimage_label already counted the components (background excluded).
+    _, _, num_regions = _corrected_and_labelled(seg_data, annot_data)
+    return num_regions
 
 
 def restrict_to_regions_containing_points(seg_data, annot_data, region_points):
@@ -276,52 +440,55 @@ def restrict_to_regions_containing_points(seg_data, annot_data, region_points):
     # restrict corrected structure to only the selected
     # connected region found at x,y,z
     # also remove small holes.
-    seg_map = (seg_data > 0).astype(np.int)
-    annot_plus = (annot_data[1] > 0).astype(np.int)
-    annot_minus = (annot_data[0] > 0).astype(np.int)
-
-    # remove anything where seg is less than 0 as this is outside of the box
-    corrected = (((seg_map + annot_plus) - annot_minus) > 0)
-    labelled = label(corrected, connectivity=2)
+    seg_map = seg_data > 0
+    _, labelled, _ = _corrected_and_labelled(seg_data, annot_data)
+    # annot_data is edited in place below so the cached labelling
+    # would be stale from here on.
+    invalidate_label_cache()
     holes_removed = 0
     removed_count = 0
-    selected_component = None
-    for x, y, z in region_points:
-        selected_label = labelled[z, y, x]
-        if selected_label == 0:
-            error = "Selected region was background. Select a foreground region to keep."
-            return annot_data, 0, 0, error
-        if selected_component is None:
-            selected_component = labelled == selected_label
-        else:
-            selected_component += labelled == selected_label
-        labelled[selected_component] = -1
-
-    disconnected_regions = labelled > 0
+    selected_labels = [labelled[z, y, x] for x, y, z in region_points]
+    if 0 in selected_labels:
+        error = "Selected region was background. Select a foreground region to keep."
+        return annot_data, 0, 0, error
+    # single pass over the label volume covers all selected points, rather
+    # than one full-volume comparison per point.
+    selected_component = np.isin(labelled, selected_labels)
+
+    disconnected_regions = (labelled > 0) & ~selected_component
     # Then update the annotation so that these regions are now background.
     annot_data[0][disconnected_regions] = 1
     annot_data[1][disconnected_regions] = 0
     removed_count += len(np.unique(labelled[disconnected_regions]))
     # removing small holes
     # this was taking too long so we restrict to the object of interest.
-    coords = np.where(selected_component > 0)
-    min_z = np.min(coords[0])
-    max_z = np.max(coords[0])
-    min_y = np.min(coords[1])
-    max_y = np.max(coords[1])
-    min_x = np.min(coords[2])
-    max_x = np.max(coords[2])
+    # find_objects gives the bounding box in a single C pass without
+    # allocating index arrays. view as uint8 (no copy) so the boolean
+    # mask acts as a single-label image. stop is exclusive, so subtract
+    # one to keep the same inclusive max values as the min/max reductions.
+    bbox = find_objects(selected_component.view(np.uint8), max_label=1)[0]
+    min_z, max_z = bbox[0].start, bbox[0].stop - 1
+    min_y, max_y = bbox[1].start, bbox[1].stop - 1
+    min_x, max_x = bbox[2].start, bbox[2].stop - 1
     # remove_small_holes
-    roi_annot_plus = (annot_data[1, min_z: max_z, min_y:max_y, min_x:max_x] > 0).astype(np.int)
-    roi_annot_minus = (annot_data[0,  min_z: max_z, min_y:max_y, min_x:max_x] > 0).astype(np.int)
+    roi_seg = seg_map[min_z: max_z, min_y:max_y, min_x:max_x]
+    roi_annot_plus = annot_data[1, min_z: max_z, min_y:max_y, min_x:max_x] > 0
+    roi_annot_minus = annot_data[0,  min_z: max_z, min_y:max_y, min_x:max_x] > 0
     # remove anything where seg is less than 0 as this is outside of the box
-    roi_corrected = (((seg_map[min_z: max_z, min_y:max_y, min_x:max_x] + roi_annot_plus) - roi_annot_minus) > 0)
-    roi_corrected_no_holes = binary_fill_holes(roi_corrected).astype(np.int)
-    roi_extra_fg = roi_corrected_no_holes - roi_corrected
-    holes_removed += len(np.unique(label(roi_extra_fg))) - 1
+    roi_corrected = (roi_seg & roi_annot_plus) | ((roi_seg | roi_annot_plus) & ~roi_annot_minus)
+    # contiguous layout for the erosion passes inside fill_holes, and a
+    # preallocated output to avoid the internal allocation.
+    roi_corrected = np.ascontiguousarray(roi_corrected)
+    roi_corrected_no_holes = np.empty_like(roi_corrected)
+    binary_fill_holes(roi_corrected, output=roi_corrected_no_holes)
+    roi_extra_fg = roi_corrected_no_holes & ~roi_corrected
+    # scipy's label returns the component count directly so there is no
+    # need for a second labelling pass plus np.unique just to count holes.
+    _, num_holes = ndimage_label(roi_extra_fg, STRUCT_26)
+    holes_removed += num_holes
     # Set the extra foreground from remove small holes to foreground in the annotation.
-    annot_data[0, min_z: max_z, min_y:max_y, min_x:max_x][roi_extra_fg > 0] = 0
-    annot_data[1, min_z: max_z, min_y:max_y, min_x:max_x][roi_extra_fg > 0] = 1
+    annot_data[0, min_z: max_z, min_y:max_y, min_x:max_x][roi_extra_fg] = 0
+    annot_data[1, min_z: max_z, min_y:max_y, min_x:max_x][roi_extra_fg] = 1
     return annot_data, removed_count, holes_removed, False
 
 
@@ -331,12 +498,10 @@ def fill_annot(annot_pixmap):
     rgb_np = np.array(qimage2ndarray.rgb_view(image))
     fg_mask = rgb_np[:, :, 0]
     fg_mask = binary_fill_holes(fg_mask)
-    fg_mask = fg_mask.astype(np.int)
-    np_rgba = np.zeros((rgb_np.shape[0], rgb_np.shape[1], 4))
+    np_rgba = np.zeros((rgb_np.shape[0], rgb_np.shape[1], 4), dtype=np.uint8)
     # set fg annotation to be new fg mask
     # set bg annotation to be opposite of the fg mask
-    np_rgba[:, :, :][fg_mask < 1] = [0, 255, 0, 180]
-    np_rgba[:, :, :][fg_mask > 0] = [255, 0, 0, 180]
+    np_rgba[~fg_mask] = (0, 255, 0, 180)
+    np_rgba[fg_mask] = (255, 0, 0, 180)
 
-    q_image = qimage2ndarray.array2qimage(np_rgba)
-    return QtGui.QPixmap.fromImage(q_image)
+    return rgba_to_pixmap(np_rgba)
@@ -20,7 +20,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 # pylint: disable=R0902
 import sys
 
-import qimage2ndarray
 from PyQt5 import QtWidgets
 from PyQt5 import QtCore
 from PyQt5 import QtGui
@@ -59,6 +58,7 @@ class ImViewer(QtWidgets.QWidget):
         self.im_width = None
         self.im_height = None
         self.brush_color = None
+        self.needs_update = False
         self.mode = view_mode # axial or sagittal
         self.parent = parent # lazy event handling.
         self.setMouseTracking(True) # track mouse over to remove cursor from pixmap
@@ -108,13 +108,13 @@ class ImViewer(QtWidgets.QWidget):
         self.inner_layout.addWidget(self.graphics_view)
         if self.mode == 'axial':
             self.vis_widget = VisibilityWidget(QtWidgets.QVBoxLayout, self,
-                                               show_guide=hasattr(self.parent, 'guide_image_dir'))
+                                               show_guide=self.parent.guide_image_dir is not None)
             self.vis_widget.setMaximumWidth(200)
             # left, top, right, bottom
             self.bottom_bar_layout.setContentsMargins(20, 0, 20, 0)
         else:
             self.vis_widget = VisibilityWidget(QtWidgets.QHBoxLayout, self,
-                                               show_guide=hasattr(self.parent, 'guide_image_dir'))
+                                               show_guide=self.parent.guide_image_dir is not None)
 
             self.vis_widget.setMaximumWidth(500)
             # left, top, right, bottom
@@ -164,6 +164,8 @@ class ImViewer(QtWidgets.QWidget):
                                        self.parent.annot_data,
                                        self.cur_slice_idx,
                                        self.mode)
+            self.parent._annot_dirty = True
+            im_utils.invalidate_label_cache()
 
     def update_slice_index(self):
         """ Render the new slice as the slice index may have changed """
@@ -302,6 +304,29 @@ class ImViewer(QtWidgets.QWidget):
             self.seg_visible = True
         self.vis_widget.seg_checkbox.setChecked(self.seg_visible)
 
+    def mark_dirty(self):
+        """ request a full refresh. Deferred until the viewer is shown
+            so hidden viewers don't render slices nobody sees. """
+        self.needs_update = True
+        if self.isVisible():
+            self.refresh_if_dirty()
+
+    def refresh_if_dirty(self):
+        if not self.needs_update:
+            return
+        self.needs_update = False
+        self.update_image()
+        self.update_cursor()
+        # hide the segmentation if we don't have it
+        if self.parent.seg_data is None and self.seg_visible:
+            # show seg in order to show the loading message
+            self.show_hide_seg()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        # pick up any refresh that was deferred while hidden.
+        self.refresh_if_dirty()
+
     def update_image(self):
         """ show a new image, annotation and segmentation """
         self.slice_nav.update_range(self.parent.img_data, self.mode)
@@ -335,6 +360,8 @@ class ImViewer(QtWidgets.QWidget):
                                                             self.parent.annot_data,
                                                             self.cur_slice_idx,
                                                             self.mode)
+        self.parent._annot_dirty = True
+        im_utils.invalidate_label_cache()
         self.scene.history.append(self.scene.annot_pixmap.copy())
         # update the other views
         self.parent.update_viewer_annot_slice()
@@ -350,8 +377,7 @@ class ImViewer(QtWidgets.QWidget):
                                         self.parent.contrast_slider.min_value,
                                         self.parent.contrast_slider.max_value,
                                         self.parent.contrast_slider.brightness_value)
-        q_image = qimage2ndarray.array2qimage(img_slice)
-        image_pixmap = QtGui.QPixmap.fromImage(q_image)
+        image_pixmap = im_utils.gray_to_pixmap(img_slice)
         im_size = image_pixmap.size()
         im_width, im_height = im_size.width(), im_size.height()
         assert im_width > 0
@@ -497,14 +523,13 @@ class ImViewer(QtWidgets.QWidget):
 
     def update_guide_image_slice(self):
         """ guide shows another image on top of the main image """
-        if hasattr(self.parent, 'guide_img_data'):
+        if self.parent.guide_img_data is not None:
             img_slice = im_utils.get_slice(self.parent.guide_img_data, self.slice_nav.slice_idx, self.mode)
             img_slice = im_utils.norm_slice(img_slice,
                                             self.parent.contrast_slider.min_value,
                                             self.parent.contrast_slider.max_value,
                                             self.parent.contrast_slider.brightness_value)
-            q_image = qimage2ndarray.array2qimage(img_slice)
-            guide_image_pixmap = QtGui.QPixmap.fromImage(q_image)
+            guide_image_pixmap = im_utils.gray_to_pixmap(img_slice)
             self.graphics_view.guide_image = guide_image_pixmap # for re-assignment after re-showing
 
             if self.guide_image_pixmap_holder:
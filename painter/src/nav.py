@@ -24,6 +24,23 @@ import json
 from pathlib import Path, PurePosixPath
 from im_utils import getDataFromDatabase
 
+# parsed settings keyed by (path, mtime). Repeated widget construction
+# then costs a stat rather than an open + json parse per call.
+_settings_cache = {}
+
+
+def load_settings(settings_path):
+    st = os.stat(settings_path)
+    key = (settings_path, st.st_mtime_ns)
+    settings = _settings_cache.get(key)
+    if settings is None:
+        with open(settings_path, 'r') as settings_file:
+            settings = json.load(settings_file)
+        _settings_cache.clear() # drop entries for older mtimes.
+        _settings_cache[key] = settings
+    return settings
+
+
 class NavWidget(QtWidgets.QWidget):
     """ Shows next and previous buttons as well as image position in folder.
     """
@@ -34,17 +51,33 @@ class NavWidget(QtWidgets.QWidget):
     def __init__(self, all_fnames, classes, before_change):
         super().__init__()
         self.image_path = None
-        self.all_fnames = all_fnames
         # validation.
         self.before_change = before_change
         self.classes = classes
         self.settings = self.get_config()
+        # assigned through the property below so the path structures
+        # are built here and rebuilt if the dataset is extended.
+        self.all_fnames = all_fnames
         self.initUI()
 
+    @property
+    def all_fnames(self):
+        return self._all_fnames
+
+    @all_fnames.setter
+    def all_fnames(self, all_fnames):
+        # rebuilt on assignment (extend dataset reassigns all_fnames):
+        # rejoining the list and linearly scanning it with list.index
+        # on every click would be O(n) per navigation.
+        self._all_fnames = all_fnames
+        self._all_paths = [
+            os.path.join(self.settings['dataset_folder'], a) for a in all_fnames
+            ]
+        self._path_to_idx = {p: i for i, p in enumerate(self._all_paths)}
+
     def get_config(self):
         settings_path = os.path.join(Path.home(), 'root_painter_settings.json')
-        settings = json.load(open(settings_path, 'r'))
-        return settings
+        return load_settings(settings_path)
 
 
     def initUI(self):
@@ -94,11 +127,7 @@ class NavWidget(QtWidgets.QWidget):
         return all_paths
     
     def get_paths(self):
-        all_files = self.all_fnames
-        all_paths = [
-            os.path.join(self.settings['dataset_folder'], a) for a in all_files
-            ]
-        return all_paths
+        return self._all_paths
 
     def show_next_image(self):
         if self.before_change():
@@ -109,10 +138,8 @@ class NavWidget(QtWidgets.QWidget):
         self.next_image_button.setText('Loading..')
         self.next_image_button.setEnabled(False)
         QtWidgets.QApplication.processEvents()
-        dir_path, _ = os.path.split(self.image_path)
-        #all_paths = self.get_path_list(dir_path)
         all_paths = self.get_paths()
-        cur_idx = all_paths.index(self.image_path)
+        cur_idx = self._path_to_idx[self.image_path]
         next_idx = cur_idx + 1
         if next_idx >= len(all_paths):
             next_idx = 0
@@ -121,10 +148,8 @@ class NavWidget(QtWidgets.QWidget):
         self.update_nav_label()
 
     def show_prev_image(self):
-        dir_path, _ = os.path.split(self.image_path)
-       # all_paths = self.get_path_list(dir_path)
         all_paths = self.get_paths()
-        cur_idx = all_paths.index(self.image_path)
+        cur_idx = self._path_to_idx[self.image_path]
         next_idx = cur_idx - 1
         if next_idx <= 0:
             next_idx = 0
@@ -137,7 +162,7 @@ class NavWidget(QtWidgets.QWidget):
         #dir_path = self.get_dir_path(self.image_path)
         #all_paths = self.get_path_list(dir_path)
         all_paths = self.get_paths()
-        cur_idx = all_paths.index(self.image_path)
+        cur_idx = self._path_to_idx[self.image_path]
         self.nav_label.setText(f'{cur_idx + 1} / {len(all_paths)}')
 
 
@@ -21,8 +21,8 @@ import sys
 import os
 from pathlib import PurePath
 import json
-from functools import partial
-import traceback
+from functools import partial, lru_cache
+from collections import OrderedDict
 from datetime import datetime
 import time
 
@@ -31,7 +31,6 @@ from scipy import ndimage
 from scipy.ndimage import binary_fill_holes
 import nibabel as nib
 
-from skimage.io import use_plugin
 from PyQt5 import QtWidgets
 from PyQt5 import QtGui
 from PyQt5 import QtCore
@@ -41,10 +40,12 @@ from view_state import ViewState
 from about import AboutWindow, LicenseWindow, ShortcutWindow
 from create_project import CreateProjectWidget
 from im_viewer import ImViewer, ImViewerWindow
-from nav import NavWidget
+from nav import NavWidget, load_settings
 from file_utils import penultimate_fname_with_segmentation
 from file_utils import get_annot_path
 from file_utils import maybe_save_annotation_3d
+from file_utils import count_annots
+from file_utils import pending_annot_data, flush_annot_writer
 from instructions import send_instruction
 from contrast_slider import ContrastSlider
 import im_utils
@@ -55,7 +56,70 @@ from pathlib import Path
 from im_utils import getDataFromDatabase
 
 
-use_plugin("pil")
+
+DICOM_SUFFIXES = ('.dcm', '.dicom', '.sr', '.DCM', '.DICOM', '.SR')
+
+
+@lru_cache(maxsize=4096)
+def seg_fname_for(fname):
+    """ segmentation fname for an image fname. Cached because the seg
+        path is rebuilt several times per tracker check and per
+        navigation for the same small set of fnames. """
+    if fname.endswith(DICOM_SUFFIXES):
+        return fname.replace('.dcm', '.nii.gz').replace('.DCM', '.nii.gz')
+    return fname.replace('.nrrd', '.nii.gz')
+
+
+class VolumeCache:
+    """ Byte-capped LRU cache of loaded volumes keyed by path. Sized to
+        hold the current image plus its neighbours so navigation can be
+        served from memory rather than disk. """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.volumes = OrderedDict()
+
+    def get(self, path):
+        volume = self.volumes.get(path)
+        if volume is not None:
+            self.volumes.move_to_end(path)
+        return volume
+
+    def put(self, path, volume):
+        self.volumes[path] = volume
+        self.volumes.move_to_end(path)
+        total = sum(v.nbytes for v in self.volumes.values())
+        while total > self.max_bytes and len(self.volumes) > 1:
+            _, evicted = self.volumes.popitem(last=False)
+            total -= evicted.nbytes
+
+
+class VolumeLoaderSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(object, str)
+
+
+class VolumeLoader(QtCore.QRunnable):
+    """ Load a volume in Qt's thread pool and emit the array along with
+        the path it was read from. Multi-hundred-MB NIfTI reads would
+        otherwise block the GUI thread for seconds per navigation. """
+
+    def __init__(self, path, load_fn):
+        super().__init__()
+        self.path = path
+        self.load_fn = load_fn
+        self.signals = VolumeLoaderSignals()
+
+    def run(self):
+        try:
+            data = self.load_fn(self.path)
+        except Exception as e:
+            # sometimes problems reading a file that is still being
+            # written. don't worry about this exception.
+            import traceback
+            print(f'Exception loading volume,{e},{traceback.format_exc()}')
+            return
+        self.signals.loaded.emit(data, self.path)
+
 
 class RootPainter(QtWidgets.QMainWindow):
 
@@ -78,10 +142,29 @@ class RootPainter(QtWidgets.QMainWindow):
 
         self.tracking = False
         self.seg_mtime = None
+        # late-bound state, assigned once a project is opened. explicit
+        # None sentinels rather than hasattr checks at the use sites.
+        self.proj_location = None
+        self.log_dir = None
+        self.classes = []
+        self.guide_image_dir = None
+        self.guide_img_data = None
+        self.contrast_slider = None
+        self.sagittal_viewer = None
+        self.coronal_viewer = None
+        self.info_label = None
+        self._preset_actions = None
         self.im_width = None
         self.im_height = None
         self.annot_data = None
         self.seg_data = None
+        self.volume_cache = VolumeCache()
+        self._prefetching = set()
+        self._annot_scratch = None
+        self._range_cache = {} # fname -> (min HU, max HU)
+        # set when annot_data is modified; a clean buffer makes
+        # save_annotation a no-op.
+        self._annot_dirty = False
         
 
         # for patch segment, useful for knowing how much annotation to send to the server.
@@ -89,6 +172,7 @@ class RootPainter(QtWidgets.QMainWindow):
         self.output_shape = (18, 194, 194)
 
         self.lines_to_log = []
+        self._log_file = None
         self.log_debounce = QtCore.QTimer()
         self.log_debounce.setInterval(500)
         self.log_debounce.setSingleShot(True)
@@ -96,10 +180,21 @@ class RootPainter(QtWidgets.QMainWindow):
         self.settings = self.get_config()
         self.initUI()
 
+    @property
+    def image_fnames(self):
+        return self._image_fnames
+
+    @image_fnames.setter
+    def image_fnames(self, fnames):
+        # rebuilt on assignment (extend dataset reassigns image_fnames):
+        # the index gives the position of each fname, so navigation
+        # doesn't need a linear scan of the full file list per click.
+        self._image_fnames = fnames
+        self._fname_index = {f: i for i, f in enumerate(fnames)}
+
     def get_config(self):
         settings_path = os.path.join(Path.home(), 'root_painter_settings.json')
-        settings = json.load(open(settings_path, 'r'))
-        return settings
+        return load_settings(settings_path)
 
     def initUI(self):
         if len(sys.argv) < 2:
@@ -145,8 +240,16 @@ class RootPainter(QtWidgets.QMainWindow):
             self.proj_location = self.sync_dir / PurePath(settings['location'])
           #  self.image_fnames = settings['file_names']
             self.image_fnames = getDataFromDatabase(self.config)
+            # fixed for the life of the project, so derive once here
+            # rather than on every navigation in update_file.
+            self._dataset_prefix = os.path.basename(str(self.dataset_dir)) + os.path.sep
             self.seg_dir = self.proj_location / 'segmentations'
             self.log_dir = self.proj_location / 'logs'
+            if self._log_file is not None:
+                # a different project may have been open before; the log
+                # file is reopened lazily against the new log dir.
+                self._log_file.close()
+                self._log_file = None
 
             self.train_seg_dirs = []
             self.train_annot_dirs = []
@@ -197,31 +300,39 @@ class RootPainter(QtWidgets.QMainWindow):
 
     def log_debounced(self):
         """ write to log file only so often to avoid lag """
-        with open(os.path.join(self.log_dir, 'client.csv'), 'a+') as log_file:
-            while self.lines_to_log:
-                line = self.lines_to_log[0]
-                log_file.write(line)
-                self.lines_to_log = self.lines_to_log[1:]
+        if self._log_file is None:
+            self._log_file = open(os.path.join(self.log_dir, 'client.csv'), 'a')
+        # swap the buffer in one go and write it with a single call
+        # rather than popping the head line by line (quadratic).
+        lines, self.lines_to_log = self.lines_to_log, []
+        self._log_file.write(''.join(
+            f"{datetime.fromtimestamp(t / 1e9)}|{t / 1e9}|{m}\n"
+            for t, m in lines))
+        self._log_file.flush()
 
     def log(self, message):
-        self.lines_to_log.append(f"{datetime.now()}|{time.time()}|{message}\n")
+        # formatting is deferred to log_debounced so logging from mouse
+        # event handlers costs a tuple append rather than datetime work.
+        # time_ns is a bare clock read with no float conversion.
+        self.lines_to_log.append((time.time_ns(), message))
         self.log_debounce.start() # write after 1 second
 
     def update_file(self, fpath):
         """ Invoked when the file to view has been changed by the user.
             Show image file and it's associated annotation and segmentation """
         # save annotation for current file before changing to new file.
-        self.log(f'update_file_start,fname:{os.path.basename(fpath)},view_state:{self.view_state}')
+        basename = os.path.basename(fpath)
+        self.log(f'update_file_start,fname:{basename},view_state:{self.view_state}')
 
         delete_lock_files_for_current_user(self.proj_location) 
-        lock_file_path = get_lock_file_path(self.proj_location, os.path.basename(fpath))
+        lock_file_path = get_lock_file_path(self.proj_location, basename)
         if lock_file_path:
-            self.msg = show_locked_message(self.proj_location, os.path.basename(fpath))
+            self.msg = show_locked_message(self.proj_location, basename)
             # if a file is locked then show a warning to the user
             self.nav.update_to_next_image()
             return
 
-        create_lock_file(self.proj_location, os.path.basename(fpath)) 
+        create_lock_file(self.proj_location, basename) 
         self.tracking = False # take a break from tracking until we get the next image.
         
         if self.view_state == ViewState.ANNOTATING:
@@ -230,13 +341,28 @@ class RootPainter(QtWidgets.QMainWindow):
         # basename = os.path.basename(fpath)
         # dirname = os.path.basename(os.path.dirname(fpath))
         # self.fname = os.path.join(dirname, basename)
-        _, _, self.fname = fpath.partition(
-            os.path.basename(self.dataset_dir._str) + os.path.sep)
+        _, _, self.fname = fpath.partition(self._dataset_prefix)
         self.image_path = os.path.join(self.dataset_dir._str, self.fname)
         #etDataFromDatabase(self.settings)
-        self.img_data = im_utils.load_image(self.image_path) 
+        cached = self.volume_cache.get(self.image_path)
+        if cached is not None:
+            # prefetched by a previous navigation - no disk wait.
+            self._on_image_loaded(cached, self.image_path)
+            return
+        # load off the GUI thread; _on_image_loaded continues once the
+        # array is ready so the event loop stays responsive meanwhile.
+        loader = VolumeLoader(self.image_path, im_utils.load_image)
+        loader.signals.loaded.connect(self._on_image_loaded)
+        QtCore.QThreadPool.globalInstance().start(loader)
+
+    def _on_image_loaded(self, img_data, image_path):
+        # the user may have navigated again while the load ran.
+        if image_path != self.image_path:
+            return
+        fpath = image_path
+        self.img_data = img_data
         # if a guide image directory is specified - TODO: Consider removing guide image functionality if it isn't used frequently
-        if hasattr(self, 'guide_image_dir'):
+        if self.guide_image_dir is not None:
             guide_image_path = os.path.join(os.path.join(self.guide_image_dir, self.fname))
             # and a guide image is available for the current image.
             if os.path.isfile(guide_image_path):
@@ -250,7 +376,16 @@ class RootPainter(QtWidgets.QMainWindow):
 
         self.update_annot_and_seg()
 
-        self.contrast_slider.update_range(self.img_data)
+        hu_range = self._range_cache.get(self.fname)
+        if hu_range is not None:
+            self.contrast_slider.apply_range(*hu_range)
+        else:
+            # the min/max scan reads the whole volume; run it in the
+            # pool so the first render doesn't wait on it.
+            scanner = VolumeLoader(
+                self.fname, lambda _, img=img_data: (img.min(), img.max()))
+            scanner.signals.loaded.connect(self._on_range_computed)
+            QtCore.QThreadPool.globalInstance().start(scanner)
         self.update_window_title()
 
         # only segment if a segmentation is missing.
@@ -260,8 +395,8 @@ class RootPainter(QtWidgets.QMainWindow):
         
         # segment the next image also.
         
-        cur_im_idx = self.image_fnames.index(self.fname)
-        if cur_im_idx < len(self.image_fnames):    
+        cur_im_idx = self._fname_index.get(self.fname)
+        if cur_im_idx is not None and cur_im_idx < len(self.image_fnames):    
             next_im_fname = self.image_fnames[cur_im_idx+1]
             num_segmentations = len(self.get_all_seg_paths())
             # dont segment the next image early on in training (first 10 images).
@@ -271,6 +406,34 @@ class RootPainter(QtWidgets.QMainWindow):
 
 
         self.log(f'update_file_end,fname:{os.path.basename(fpath)},view_state:{self.view_state}')
+        self.volume_cache.put(image_path, img_data)
+        # warm the cache for the likely next navigation targets once the
+        # current image is on screen.
+        self._prefetch_neighbours()
+
+    def _on_range_computed(self, hu_range, fname):
+        self._range_cache[fname] = hu_range
+        if fname == self.fname:
+            self.contrast_slider.apply_range(*hu_range)
+
+    def _prefetch_neighbours(self):
+        idx = self._fname_index.get(self.fname)
+        if idx is None:
+            return
+        for n_idx in (idx + 1, idx - 1):
+            if not 0 <= n_idx < len(self.image_fnames):
+                continue
+            path = os.path.join(self.dataset_dir._str, self.image_fnames[n_idx])
+            if self.volume_cache.get(path) is not None or path in self._prefetching:
+                continue
+            self._prefetching.add(path)
+            loader = VolumeLoader(path, im_utils.load_image)
+            loader.signals.loaded.connect(self._on_prefetched)
+            QtCore.QThreadPool.globalInstance().start(loader)
+
+    def _on_prefetched(self, img_data, path):
+        self._prefetching.discard(path)
+        self.volume_cache.put(path, img_data)
 
     def navigate_to_top_of_structure(self, roi_connected_structure):
         # Used to speed things up when we first open an image, as this is where a user 
@@ -284,6 +447,10 @@ class RootPainter(QtWidgets.QMainWindow):
 
 
     def update_annot_and_seg(self):
+        # the annot scratch buffer is reused (same id and shape) and
+        # freed seg buffers can be remapped at the same address, so the
+        # cached labelling cannot be trusted across a navigation.
+        im_utils.invalidate_label_cache()
         self.annot_path = None
         self.view_state = ViewState.LOADING_SEG 
         if self.fname:
@@ -291,7 +458,12 @@ class RootPainter(QtWidgets.QMainWindow):
                                              self.get_train_annot_dir(),
                                              self.get_val_annot_dir())
         
-        if self.annot_path and os.path.isfile(self.annot_path):
+        pending_annot = pending_annot_data(self.annot_path)
+        if pending_annot is not None:
+            # a queued save for this image hasn't reached disk yet -
+            # the file would show the pre-edit state.
+            self.annot_data = pending_annot
+        elif self.annot_path and os.path.isfile(self.annot_path):
             self.annot_data = im_utils.load_annot(self.annot_path, self.img_data.shape)
         else:
             # otherwise create empty annotation array
@@ -299,7 +471,19 @@ class RootPainter(QtWidgets.QMainWindow):
             # file hasn't been found then create an empty array to be
             # used for storing the annotation information.
             # channel for bg (0) and fg (1)
-            self.annot_data = np.zeros([2] + list(self.img_data.shape))
+            # uint8 as annotations are binary - a float64 buffer here
+            # was 8x the memory for the same information. The buffer is
+            # reused between images of the same shape to avoid
+            # reallocating hundreds of MB per navigation.
+            shape = tuple([2] + list(self.img_data.shape))
+            if self._annot_scratch is None or self._annot_scratch.shape != shape:
+                self._annot_scratch = np.zeros(shape, dtype=np.uint8)
+            else:
+                self._annot_scratch.fill(0)
+            self.annot_data = self._annot_scratch
+
+        # freshly loaded (or empty) annotation - nothing to save yet.
+        self._annot_dirty = False
 
         if self.fname and os.path.isfile(self.get_seg_path()):
             print('load seg')
@@ -312,12 +496,8 @@ class RootPainter(QtWidgets.QMainWindow):
             self.seg_data = None
            
         for v in self.viewers:
-            v.update_image()
-            v.update_cursor()
-            # hide the segmentation if we don't have it
-            if self.seg_data is None and v.seg_visible:
-                # show seg in order to show the loading message
-                v.show_hide_seg()
+            # hidden viewers defer the refresh until shown.
+            v.mark_dirty()
 
         """
         if self.seg_data is not None:
@@ -365,14 +545,9 @@ class RootPainter(QtWidgets.QMainWindow):
     def get_seg_path(self, fname=None):
         if fname is None:
             fname = self.fname
-        if fname.endswith(
-            ('.dcm', '.dicom', '.sr', '.DCM', '.DICOM', '.SR')):
-            seg_fname = fname.replace('.dcm', '.nii.gz').replace('.DCM', '.nii.gz')
-        else:
-            seg_fname = fname.replace('.nrrd', '.nii.gz')
-        #seg_fname = fname.replace('.nrrd', '.nii.gz')
+        seg_fname = seg_fname_for(fname)
         # just seg path for current class.
-        if hasattr(self, 'classes') and len(self.classes) > 1:
+        if len(self.classes) > 1:
             return os.path.join(self.seg_dir,
                                 self.cur_class,
                                 seg_fname)
@@ -382,13 +557,8 @@ class RootPainter(QtWidgets.QMainWindow):
     def get_train_seg_path(self, fname=None):
         if fname is None:
             fname = self.fname
-        if fname.endswith(
-            ('.dcm', '.dicom', '.sr', '.DCM', '.DICOM', '.SR')):
-            seg_fname = fname.replace('.dcm', '.nii.gz').replace('.DCM', '.nii.gz')
-        else:
-            seg_fname = fname.replace('.nrrd', '.nii.gz')
-        #seg_fname = fname.replace('.nrrd', '.nii.gz')
-        if hasattr(self, 'classes') and len(self.classes) > 1:
+        seg_fname = seg_fname_for(fname)
+        if len(self.classes) > 1:
             return os.path.join(self.proj_location,
                                 'train_segmentations',
                                 self.cur_class,
@@ -397,7 +567,7 @@ class RootPainter(QtWidgets.QMainWindow):
 
 
     def get_all_seg_paths(self):
-        if hasattr(self, 'classes') and len(self.classes) > 1:
+        if len(self.classes) > 1:
             spaths = []
             for c in self.classes:
                 spaths.append(os.path.join(self.seg_dir,
@@ -513,13 +683,23 @@ class RootPainter(QtWidgets.QMainWindow):
                             " - Not approved for clinical use")
 
     def closeEvent(self, _):
-        if hasattr(self, 'proj_location'):
+        try:
+            # don't lose an annotation enqueued by the final save.
+            flush_annot_writer()
+        except Exception as ex:
+            print('failed to write annotation on close', ex)
+        if self.lines_to_log and self.log_dir is not None:
+            self.log_debounced()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+        if self.proj_location is not None:
             delete_lock_files_for_current_user(self.proj_location)
-        if hasattr(self, 'contrast_slider'):
+        if self.contrast_slider is not None:
             self.contrast_slider.close()
-        if hasattr(self, 'sagittal_viewer'):
+        if self.sagittal_viewer is not None:
             self.sagittal_viewer.close()
-        if hasattr(self, 'coronal_viewer'):
+        if self.coronal_viewer is not None:
             self.coronal_viewer.close()
 
 
@@ -675,19 +855,21 @@ class RootPainter(QtWidgets.QMainWindow):
         if self.tracking:
             return
         self.tracking = True
-        def check():
+        def check(_changed_path=None):
             # check for any messages
-            messages = os.listdir(str(self.message_dir))
+            with os.scandir(str(self.message_dir)) as entries:
+                messages = list(entries)
 
+            if messages and self.info_label is not None:
+                # only the latest message matters for display.
+                self.info_label.setText(messages[-1].name)
             for m in messages:
-                if hasattr(self, 'info_label'):
-                    self.info_label.setText(m)
                 try:
                     # Added try catch because this error happened (very rarely)
                     # PermissionError: [WinError 32]
                     # The process cannot access the file because `it is
                     # being used by another process
-                    os.remove(os.path.join(self.message_dir, m))
+                    os.remove(m.path)
                 except Exception as e:
                     print('Caught exception when trying to detele msg', e)
                                 
@@ -701,34 +883,58 @@ class RootPainter(QtWidgets.QMainWindow):
                     if self.seg_mtime is None or new_mtime != self.seg_mtime:
                         print('load new seg now')
                         self.log(f'load_seg,fname:{os.path.basename(self.get_seg_path())}')
-                        self.seg_data = im_utils.load_seg(self.get_seg_path())
-                        self.axial_viewer.update_seg_slice()
-                        # Change to annotating state.                        
-                        self.view_state = ViewState.ANNOTATING
-                        for v in self.viewers:
-                            v.update_cursor()
-                            # for some reason cursor doesn't update straight away sometimes.
-                            # trigger again half a second later to make sure 
-                            # the correct cursor is shown.
-                            QtCore.QTimer.singleShot(500, v.update_cursor)
-                            if v.isVisible():
-                                v.update_seg_slice()
-
+                        # record the mtime up front so another watcher
+                        # event doesn't queue a duplicate load.
                         self.seg_mtime = new_mtime
-                        self.nav.next_image_button.setText('Save && Next >')
-                        self.nav.next_image_button.setEnabled(True)
+                        loader = VolumeLoader(self.get_seg_path(),
+                                              im_utils.load_seg)
+                        loader.signals.loaded.connect(self._on_seg_loaded)
+                        QtCore.QThreadPool.globalInstance().start(loader)
                     else:
                         pass
            
                 except Exception as e:
+                    import traceback
                     print(f'Exception loading segmentation,{e},{traceback.format_exc()}')
                     # sometimes problems reading file.
                     # don't worry about this exception
             else:
                 pass
-            QtCore.QTimer.singleShot(500, check)
+        # event driven rather than polling: the watcher fires only when
+        # the server actually writes a message or segmentation, so the
+        # UI thread isn't woken every 500ms to list unchanged dirs.
+        watch_paths = [str(self.message_dir), str(self.seg_dir)]
+        if len(self.classes) > 1:
+            # segmentations live in per-class sub dirs.
+            watch_paths += [os.path.join(str(self.seg_dir), c)
+                            for c in self.classes]
+        self.fs_watcher = QtCore.QFileSystemWatcher(
+            [p for p in watch_paths if os.path.isdir(p)])
+        self.fs_watcher.directoryChanged.connect(check)
+        # run once to pick up anything written before the watcher existed.
         QtCore.QTimer.singleShot(500, check)
 
+    def _on_seg_loaded(self, seg_data, seg_path):
+        if seg_path != self.get_seg_path():
+            # the user navigated to another image while the load ran.
+            return
+        self.seg_data = seg_data
+        # see update_annot_and_seg - a fresh seg invalidates the cache.
+        im_utils.invalidate_label_cache()
+        self.axial_viewer.update_seg_slice()
+        # Change to annotating state.
+        self.view_state = ViewState.ANNOTATING
+        for v in self.viewers:
+            v.update_cursor()
+            # for some reason cursor doesn't update straight away sometimes.
+            # trigger again half a second later to make sure
+            # the correct cursor is shown.
+            QtCore.QTimer.singleShot(500, v.update_cursor)
+            if v.isVisible():
+                v.update_seg_slice()
+        self.nav.next_image_button.setText('Save && Next >')
+        self.nav.next_image_button.setEnabled(True)
+
     def close_project_window(self):
         self.close()
         self.closed.emit()
@@ -764,21 +970,27 @@ class RootPainter(QtWidgets.QMainWindow):
         menus.add_extras_menu(self, menu_bar, project_open=True)
 
 
+    def _select_contrast_preset(self, preset, _checked=False):
+        # QAction.triggered supplies a checked argument, so a partial on
+        # preset_selected directly would get the wrong arity.
+        self.contrast_slider.preset_selected(preset)
+
     def add_contrast_setting_options(self, view_menu):
-        preset_count = 0
-        for preset in self.contrast_presets:
-            def add_preset_option(new_preset, preset_count):
-                preset = new_preset
+        if self._preset_actions is None:
+            # presets are fixed per session, so the actions (and their
+            # bound handlers) only need creating once even if the menu
+            # is rebuilt.
+            self._preset_actions = []
+            for preset_count, preset in enumerate(self.contrast_presets, start=1):
                 preset_btn = QtWidgets.QAction(QtGui.QIcon('missing.png'),
                                                f'{preset} contrast settings', self)
                 preset_btn.setShortcut(QtGui.QKeySequence(f"Alt+{preset_count}"))
                 preset_btn.setStatusTip(f'Use {preset} contrast settings')
-                def on_select():
-                    self.contrast_slider.preset_selected(preset)
-                preset_btn.triggered.connect(on_select)
-                view_menu.addAction(preset_btn)
-            preset_count += 1
-            add_preset_option(preset, preset_count)
+                preset_btn.triggered.connect(
+                    partial(self._select_contrast_preset, preset))
+                self._preset_actions.append(preset_btn)
+        for preset_btn in self._preset_actions:
+            view_menu.addAction(preset_btn)
 
     def stop_training(self):
         self.info_label.setText("Stopping training...")
@@ -803,6 +1015,10 @@ class RootPainter(QtWidgets.QMainWindow):
 
     def save_annotation(self):
         if self.annot_data is not None:
+            if not self._annot_dirty:
+                # the user didn't paint anything since this annotation
+                # was loaded, so skip the slice stores and disk writes.
+                return
             for v in self.viewers:
                 v.store_annot_slice()
            # _, _, fname = self.get_seg_path().partition('segmentations/')
@@ -815,6 +1031,7 @@ class RootPainter(QtWidgets.QMainWindow):
                                                        self.get_train_annot_dir(),
                                                        self.get_val_annot_dir(),
                                                        self.log)
+            self._annot_dirty = False
             if self.annot_path:
                 #if self.auto_complete_enabled:
                 # also save the segmentation, as this updated due to patch updates (potencially).
@@ -838,7 +1055,7 @@ class RootPainter(QtWidgets.QMainWindow):
                     # fully corrected.
                     
 
-                    if len(os.listdir(self.get_train_annot_dir())) >= 4:
+                    if count_annots(self.get_train_annot_dir(), cap=4) >= 4:
                         img.to_filename(out_path_seg)
                 else:
                     # otherwise if it was saved to validation then start training
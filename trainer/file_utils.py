@@ -64,7 +64,9 @@ def ls_annotations(dir_path):
             # Don't show hidden files
             # These can happen due to issues like file system 
             # synchonisation technology. RootPainter doesn't use them anywhere
-            fnames = [f for f in fnames if f[0] != '.']
+            # (checked on the basename, as the recursive listing
+            # returns relative paths that may start with a class directory)
+            fnames = [f for f in fnames if os.path.basename(f)[0] != '.']
             return fnames
         except Exception as ex:
             print(f'exception listing file names from {dir_path}')
@@ -33,7 +33,10 @@ def dice_loss(predictions, labels):
     labels = labels.view(-1)
     intersection = torch.sum(torch.mul(preds, labels))
     union = torch.sum(preds) + torch.sum(labels)
-    return 1 - ((2 * intersection) / (union))
+    # smoothed so the loss stays defined (and differentiable) when
+    # there are no labelled foreground voxels.
+    eps = 1e-6
+    return 1 - ((2 * intersection + eps) / (union + eps))
 
 
 def combined_loss(predictions, labels):
@@ -41,12 +44,10 @@ def combined_loss(predictions, labels):
     # if they are bigger than 1 you get a strange gpu error
     # without a stack track so you will have no idea why.
     assert torch.max(labels) <= 1
-    if torch.sum(labels) > 0:
-        return (dice_loss(predictions, labels) +
-                (0.3 * cross_entropy(predictions, labels)))
-    # When no roots use only cross entropy
-    # as dice is undefined.
-    return 0.3 * cross_entropy(predictions, labels)
+    # dice is smoothed so no need to branch on torch.sum(labels) here,
+    # which forced a gpu sync per call just to pick the loss terms.
+    return (dice_loss(predictions, labels) +
+            (0.3 * cross_entropy(predictions, labels)))
 
 
 def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
@@ -73,10 +74,14 @@ def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
     defined_total = 0
     class_losses = [] # loss for each class
 
-    instance_tps = [0 for _ in range(outputs.shape[0])]
-    instance_tns = list(instance_tps)
-    instance_fps = list(instance_tps)
-    instance_fns = list(instance_tps)
+    # O(1) channel lookup, list.index scanned project_classes for every
+    # tile in the batch.
+    class_to_idx = {c: i for i, c in enumerate(project_classes)}
+
+    # per instance confusion counts (tn, fp, fn, tp) accumulated on the
+    # device and moved to the cpu in one transfer after the class loop.
+    instance_counts = torch.zeros((outputs.shape[0], 4),
+                                  dtype=torch.long, device=device)
 
     for unique_class in project_classes:
 
@@ -91,6 +96,7 @@ def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
         masks = [] # and regions of the image that were annotated.
         seg_tiles = []
         seg_class_outputs = []
+        tile_im_idxs = [] # instance each gathered tile came from.
         
         # go through each instance in the batch.
         for im_idx in range(outputs.shape[0]):
@@ -105,36 +111,16 @@ def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
                     fg_tile = batch_fg_tiles[im_idx][i][17:-17,17:-17,17:-17]
                     bg_tile = batch_bg_tiles[im_idx][i][17:-17,17:-17,17:-17]
                     mask = fg_tile + bg_tile
-                    class_idx = project_classes.index(classname) * 2 # posiion in output.
+                    class_idx = class_to_idx[classname] * 2 # posiion in output.
                     class_output = outputs[im_idx][class_idx:class_idx+2]
-    
-
 
                     mask = mask.to(device)
                     fg_tile = fg_tile.to(device)
 
-                    # I want to get tps, tns, fps and fns 
-                    # from fg_tile, mask, class_outputs
-                    softmaxed = softmax(class_output, 0)
-                    fg_prob = softmaxed[1]
-
-
-                    assert fg_prob.shape == mask.shape, (
-                        f"fg_prob shape {fg_prob.shape} and mask shape {mask.shape}"
-                        f"should be equal")
-                    fg_prob = fg_prob * mask
-                    class_pred = fg_prob > 0.5   
-                    class_pred = class_pred[mask > 0]
-                    fg = fg_tile[mask > 0]
-                    
-                    instance_tps[im_idx] += torch.sum((fg == 1) * (class_pred == 1)).cpu().numpy()
-                    instance_tns[im_idx] += torch.sum((fg == 0) * (class_pred == 0)).cpu().numpy()
-                    instance_fps[im_idx] += torch.sum((fg == 0) * (class_pred == 1)).cpu().numpy()
-                    instance_fns[im_idx] += torch.sum((fg == 1) * (class_pred == 0)).cpu().numpy()
-
                     masks.append(mask)
                     fg_tiles.append(fg_tile)
                     class_outputs.append(class_output)
+                    tile_im_idxs.append(im_idx)
 
                     seg_tile = batch_seg_tiles[im_idx][i]
                     if seg_tile is not None:
@@ -148,12 +134,33 @@ def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
 
         if not len(fg_tiles):
             continue
-        
+
+        # stack once and compute the metrics for every tile of this class
+        # in one go, rather than a softmax and four reductions per tile.
+        fg_tiles = torch.stack(fg_tiles)
+        masks = torch.stack(masks)
+        class_outputs = torch.stack(class_outputs)
+
+        softmaxed = softmax(class_outputs, 1)
+        fg_probs = softmaxed[:, 1]
+
+        assert fg_probs.shape == masks.shape, (
+            f"fg_probs shape {fg_probs.shape} and masks shape {masks.shape}"
+            f"should be equal")
+        class_preds = (fg_probs * masks) > 0.5
+
+        # pack (tile, fg, pred) into one code so a single bincount gives
+        # the (tn, fp, fn, tp) counts for every tile of this class.
+        code = fg_tiles.long() * 2 + class_preds.long()
+        tile_ids = torch.arange(len(tile_im_idxs), device=device)
+        code = code + tile_ids.view(-1, 1, 1, 1) * 4
+        counts = torch.bincount(code[masks > 0],
+                                minlength=len(tile_im_idxs) * 4)
+        instance_counts.index_add_(0,
+                                   torch.as_tensor(tile_im_idxs, device=device),
+                                   counts.view(-1, 4))
+
         if compute_loss:
-            fg_tiles = torch.stack(fg_tiles).to(device)
-            masks = torch.stack(masks).to(device)
-            class_outputs = torch.stack(class_outputs)
-                        
             if len(seg_class_outputs):
 
                 seg_class_outputs = torch.stack(seg_class_outputs)
@@ -172,6 +179,11 @@ def get_batch_loss(outputs, batch_fg_tiles, batch_bg_tiles, batch_seg_tiles,
             class_loss = combined_loss(class_outputs, fg_tiles)
             class_losses.append(class_loss)
 
+    counts = instance_counts.cpu().numpy()
+    instance_tns = list(counts[:, 0])
+    instance_fps = list(counts[:, 1])
+    instance_fns = list(counts[:, 2])
+    instance_tps = list(counts[:, 3])
     if compute_loss:
         return torch.mean(torch.stack(class_losses)), instance_tps, instance_tns, instance_fps, instance_fns
     return None, instance_tps, instance_tns, instance_fps, instance_fns
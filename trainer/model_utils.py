@@ -22,26 +22,45 @@ import traceback
 import numpy as np
 import torch
 import copy
-from skimage import img_as_float32
 import im_utils
 from unet3d import UNet3D, SmallUNet3D
 from file_utils import ls
-from torch.nn.functional import softmax
-import torch.nn.functional as F
 from loss import get_batch_loss
 
 cached_model = None
 cached_model_path = None
 use_fake_cnn = False
 
+# compiled wrapper for inference, so segmenting many images with the
+# same model only pays the compile cost once. Bounded to the current
+# model - compiling for a newer checkpoint evicts the old wrapper,
+# otherwise every checkpoint segmented during a session would stay
+# pinned in memory (weights plus inductor artifacts). The model is
+# kept in the value to stop its id being reused after gc.
+_compiled_models = {}
+
+
+def compile_for_inference(model):
+    """ return a torch.compile wrapper for model where supported.
+        every segmentation tile has the same shape, so the compiler can
+        fuse and specialize the forward pass. Falls back to the model
+        unchanged on older torch or without a GPU. """
+    if not hasattr(torch, 'compile') or not torch.cuda.is_available():
+        return model
+    cached = _compiled_models.get(id(model))
+    if cached is None:
+        _compiled_models.clear()
+        cached = (model, torch.compile(model))
+        _compiled_models[id(model)] = cached
+    return cached[1]
+
 def fake_cnn(tiles_for_gpu):
     """ Useful debug function for checking tile layout etc """
-    output = []
-    for t in tiles_for_gpu:
-        v = t[0, 17:-17, 17:-17, 17:-17].data.cpu().numpy()
-        v_mean = np.mean(v)
-        output.append((v > v_mean).astype(np.int8))
-    return np.array(output)
+    # threshold on the device with one batched mean and a single
+    # transfer, rather than a sync per tile.
+    v = tiles_for_gpu[:, 0, 17:-17, 17:-17, 17:-17]
+    means = v.mean(dim=(1, 2, 3), keepdim=True)
+    return (v > means).to(torch.int8).data.cpu().numpy()
  
 def get_in_w_out_w_pairs():
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -118,9 +137,18 @@ def get_in_w_out_w_for_memory(num_classes, small_unet):
     raise Exception('Could not find patch small enough for available GPU memory')
 
 
+# sorted model fnames keyed on directory mtime, so repeated calls cost a
+# stat rather than a full directory listing (slow on network drives).
+_model_dir_cache = {} # model_dir -> (mtime_ns, sorted fnames)
+
+
 def get_latest_model_paths(model_dir, k):
-    fnames = ls(model_dir)
-    fnames = sorted(fnames)[-k:]
+    mtime_ns = os.stat(model_dir).st_mtime_ns
+    cached = _model_dir_cache.get(model_dir)
+    if cached is None or cached[0] != mtime_ns:
+        cached = (mtime_ns, sorted(ls(model_dir)))
+        _model_dir_cache[model_dir] = cached
+    fnames = cached[1][-k:]
     fpaths = [os.path.join(model_dir, f) for f in fnames]
     return fpaths
 
@@ -132,8 +160,11 @@ def load_model(model_path, classes, small_unet):
     global cached_model_path
     
     # using cache can save up to half a second per segmentation with network drives
+    # the cached model is returned as a shared reference - deepcopying it
+    # allocated and copied every parameter tensor on the GPU per call.
+    # Callers that update the weights must take their own copy.
     if model_path == cached_model_path:
-        return copy.deepcopy(cached_model)
+        return cached_model
 
     # two channels as one is input image and another is some of the fg and bg annotation
     # each non-empty channel in the annotation is included with 50% chance.
@@ -143,19 +174,30 @@ def load_model(model_path, classes, small_unet):
         model = SmallUNet3D(num_classes=len(classes), im_channels=1) # 3 channels as annotation may be used as input.
     else:
         model = UNet3D(num_classes=len(classes), im_channels=1)
-    try:
-        model.load_state_dict(torch.load(model_path, map_location=device))
-        model = torch.nn.DataParallel(model)
-    # pylint: disable=broad-except, bare-except
-    except:
-        model = torch.nn.DataParallel(model)
-        model.load_state_dict(torch.load(model_path, map_location=device))
+    state = torch.load(model_path, map_location=device)
+    # models may have been saved bare or wrapped in DataParallel. Detect
+    # the module. prefix on the keys rather than attempting the load and
+    # paying for a second unpickle + state_dict apply when it fails.
+    has_prefix = next(iter(state)).startswith('module.')
+    if torch.cuda.device_count() > 1:
+        if has_prefix:
+            model = torch.nn.DataParallel(model)
+            model.load_state_dict(state)
+        else:
+            model.load_state_dict(state)
+            model = torch.nn.DataParallel(model)
+    else:
+        # DataParallel costs a python scatter/gather on every forward,
+        # so with a single gpu (or cpu) load into the bare model.
+        if has_prefix:
+            state = {k[len('module.'):]: v for k, v in state.items()}
+        model.load_state_dict(state)
     if not use_fake_cnn:
         model.to(device)
     # store in cache as most frequest model is laoded often
     cached_model_path = model_path
     cached_model = model
-    return copy.deepcopy(model)
+    return model
 
 
 def random_model(classes, small_unet):
@@ -169,7 +211,8 @@ def random_model(classes, small_unet):
         model = SmallUNet3D(num_classes=len(classes), im_channels=1) # 3 channels as annotation may be used as input.
     else:
         model = UNet3D(num_classes=len(classes), im_channels=1)
-    model = torch.nn.DataParallel(model)
+    if torch.cuda.device_count() > 1:
+        model = torch.nn.DataParallel(model)
     if not use_fake_cnn: 
         model.to(device)
     return model
@@ -217,6 +260,11 @@ def save_model(model_dir, cur_model, prev_model_path):
     model_path = os.path.join(model_dir, model_name)
     print('saving', model_path, time.strftime('%H:%M:%S', time.localtime(now)))
     torch.save(cur_model.state_dict(), model_path)
+    cached = _model_dir_cache.get(model_dir)
+    if cached is not None:
+        # model names are monotonic so appending keeps the list sorted.
+        _model_dir_cache[model_dir] = (os.stat(model_dir).st_mtime_ns,
+                                       cached[1] + [model_name])
 
 
 def ensemble_segment_3d(model_paths, image, fname, batch_size, in_w, out_w, in_d,
@@ -256,6 +304,8 @@ def segment_3d(cnn, image, batch_size, in_tile_shape, out_tile_shape, auto_compl
     """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+    cnn = compile_for_inference(cnn)
+
     # Return prediction for each pixel in the image
     # The cnn will give a the output as channels where
     # each channel corresponds to a specific class 'probability'
@@ -301,76 +351,156 @@ def segment_3d(cnn, image, batch_size, in_tile_shape, out_tile_shape, auto_compl
 
     coords = im_utils.get_coords_3d(out_im_shape, out_tile_shape)
     coord_idx = 0
-    class_output_tiles = None # list of tiles for each class
-
-    while coord_idx < len(coords):
-        tiles_to_process = []
-        coords_to_process = []
-        for _ in range(batch_size):
-            if coord_idx < len(coords):
-                coord = coords[coord_idx]
-                x_coord, y_coord, z_coord = coord
-                tile = image[z_coord:z_coord+in_tile_shape[0],
-                             y_coord:y_coord+in_tile_shape[1],
-                             x_coord:x_coord+in_tile_shape[2]]
-
-                # need to add channel dimension for GPU processing.
-                tile = np.expand_dims(tile, axis=0)
-                
-                assert tile.shape[1] == in_tile_shape[0], str(tile.shape)
-                assert tile.shape[2] == in_tile_shape[1], str(tile.shape)
-                assert tile.shape[3] == in_tile_shape[2], str(tile.shape)
-
-                tile = img_as_float32(tile)
-                tile = im_utils.normalize_tile(tile)
-                tile = img_as_float32(tile)
-                coord_idx += 1
-                tiles_to_process.append(tile) # need channel dimension
-                coords_to_process.append(coord)
-
-        tiles_to_process = np.array(tiles_to_process)
-        tiles_for_gpu = torch.from_numpy(tiles_to_process)
-
-        tiles_for_gpu = tiles_for_gpu.to(device).float()
+    pred_maps_buf = None # (num classes,) + out_im_shape, written tile by tile
+
+    use_cuda = torch.cuda.is_available()
+
+    # two staging buffers (pinned) and two device buffers so the host to
+    # device copy of the next batch can overlap the forward pass of the
+    # current one. tiles are copied in raw and normalized on the GPU in
+    # one go, rather than converting and rescaling each tile in python.
+    batch_bufs = [torch.empty((batch_size, 1) + tuple(in_tile_shape),
+                              dtype=torch.float32, pin_memory=use_cuda)
+                  for _ in range(2)]
+    device_bufs = [torch.empty((batch_size, 1) + tuple(in_tile_shape),
+                               device=device) for _ in range(2)]
+    if use_cuda:
+        copy_stream = torch.cuda.Stream()
+        copy_done = [torch.cuda.Event() for _ in range(2)]
+
+    if auto_complete_enabled:
+        # persistent 3 channel batch on the device. channels 1 and 2 (the
+        # annotation input) stay zero at inference so they are zeroed once
+        # here rather than padded into a fresh tensor every batch.
+        annot_input_buf = torch.zeros((batch_size, 3) + tuple(in_tile_shape),
+                                      device=device)
+
+    # strided view over every possible tile position in the image.
+    # nothing is copied until the coords index it in fill_batch, where
+    # one gather pulls a whole batch of tiles in a single numpy call.
+    windows = np.lib.stride_tricks.sliding_window_view(image, in_tile_shape)
+    coords_np = np.array(coords, dtype=np.intp) # (x, y, z) per row
+
+    def fill_batch(coord_idx, batch_buf):
+        """ copy up to batch_size tiles into batch_buf.
+            returns the number copied and the next coord_idx. """
+        end = min(coord_idx + batch_size, len(coords))
+        batch_coords = coords_np[coord_idx:end]
+        batch_count = len(batch_coords)
+        if batch_count:
+            tiles = windows[batch_coords[:, 2],
+                            batch_coords[:, 1],
+                            batch_coords[:, 0]]
+            # copy_ casts to float32 as it writes into the buffer.
+            batch_buf[:batch_count, 0].copy_(torch.from_numpy(tiles))
+        return batch_count, end
+
+    def send_to_device(buf_idx, batch_count):
+        """ issue the (async) host to device copy for a staged batch """
+        if use_cuda:
+            with torch.cuda.stream(copy_stream):
+                # the device buffer was last read by a batch that has
+                # already finished (its event was waited on two batches
+                # ago) so the copy can overlap the current forward pass.
+                copy_stream.wait_event(batch_read[buf_idx])
+                device_bufs[buf_idx][:batch_count].copy_(
+                    batch_bufs[buf_idx][:batch_count], non_blocking=True)
+                copy_done[buf_idx].record(copy_stream)
+        else:
+            device_bufs[buf_idx][:batch_count].copy_(
+                batch_bufs[buf_idx][:batch_count])
+
+    if use_cuda:
+        batch_read = [torch.cuda.Event() for _ in range(2)]
+
+    buf_idx = 0
+    batch_start = coord_idx
+    batch_count, coord_idx = fill_batch(coord_idx, batch_bufs[buf_idx])
+    send_to_device(buf_idx, batch_count)
+
+    while batch_count:
+        if use_cuda:
+            torch.cuda.current_stream().wait_event(copy_done[buf_idx])
+        tiles_for_gpu = device_bufs[buf_idx][:batch_count]
+        # rescale each tile to (0, 1) as im_utils.normalize_tile does.
+        # the rescale is invariant to the affine img_as_float32 conversion
+        # so it can run on the raw intensities.
+        mins = tiles_for_gpu.amin(dim=(2, 3, 4), keepdim=True)
+        maxs = tiles_for_gpu.amax(dim=(2, 3, 4), keepdim=True)
+        tiles_for_gpu = torch.where(maxs > mins,
+                                    (tiles_for_gpu - mins) / (maxs - mins),
+                                    torch.zeros_like(tiles_for_gpu))
         # TODO: consider use of detach. 
         # I might want to move to cpu later to speed up the next few operations.
         # I added .detach().cpu() to prevent a memory error.
-        # pad with zeros for the annotation input channels
-        # l,r, l,r, but from end to start     w  w  h  h  d  d, c, c, b, b
         if auto_complete_enabled:
-            # add channels for annotation if auto_complete enabled
-            tiles_for_gpu = F.pad(tiles_for_gpu, (0, 0, 0, 0, 0, 0, 0, 2), 'constant', 0)
+            # write the image into channel 0 of the zero-initialized
+            # annotation input buffer instead of F.pad allocating and
+            # zero-filling a new tensor every batch.
+            annot_input_buf[:batch_count, 0].copy_(tiles_for_gpu[:, 0])
+            tiles_for_gpu = annot_input_buf[:batch_count]
         # tiles shape after padding torch.Size([4, 3, 52, 228, 228])
-        outputs = cnn(tiles_for_gpu).detach().cpu()
-        # bg channel index for each class in network output.
-        class_idxs = [x * 2 for x in range(outputs.shape[1] // 2)]
-        
-        if class_output_tiles is None:
-            class_output_tiles = [[] for _ in class_idxs]
-
-        for i, class_idx in enumerate(class_idxs):
-            class_output = outputs[:, class_idx:class_idx+2]
-            # class_output : (batch_size, bg/fg, depth, height, width)
-            softmaxed = softmax(class_output, 1) 
-            foreground_probs = softmaxed[:, 1]  # just the foreground probability.
-            predicted = foreground_probs > 0.5
-            predicted = predicted.int()
-            pred_np = predicted.data.cpu().numpy()
-            for out_tile in pred_np:
-                class_output_tiles[i].append(out_tile)
-
-    class_pred_maps = []
-    for i, output_tiles in enumerate(class_output_tiles):
-        # reconstruct for each class
-        reconstructed = im_utils.reconstruct_from_tiles(output_tiles,
-                                                        coords, out_im_shape)
-        if padded_for_patch:
-            # go back to the original shape before padding.
-            # what ever we added on to make it as big as the patch size
-            # now take that away.
-            reconstructed = reconstructed[:reconstructed.shape[0] - patch_pad_z,
-                                          :reconstructed.shape[1] - patch_pad_y,
-                                          :reconstructed.shape[2] - patch_pad_x]
-        class_pred_maps.append(reconstructed)
-
-    return class_pred_maps
+        # inference only, so run the forward pass in mixed precision.
+        # halves the activation traffic and uses the tensor cores, with
+        # the weights kept in fp32. no_grad stops every intermediate
+        # activation being saved for a backward pass that never runs,
+        # roughly halving allocator traffic and peak memory per batch.
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=use_cuda):
+            outputs_on_device = cnn(tiles_for_gpu)
+
+        if use_cuda:
+            # all reads of this device buffer are queued, so the next
+            # copy into it only has to wait for this point.
+            batch_read[buf_idx].record()
+
+        # while the forward pass runs, stage and send the next batch so
+        # the python tile prep and the copy overlap the compute.
+        next_start = coord_idx
+        if use_cuda:
+            # the previous copy out of this pinned buffer must have
+            # landed on the device before the host refills it.
+            copy_done[1 - buf_idx].synchronize()
+        next_count, coord_idx = fill_batch(coord_idx, batch_bufs[1 - buf_idx])
+        if next_count:
+            send_to_device(1 - buf_idx, next_count)
+
+        if pred_maps_buf is None:
+            # the class count is constant so derive it from the first
+            # forward pass only.
+            num_out_classes = outputs_on_device.shape[1] // 2
+            pred_maps_buf = torch.zeros((num_out_classes,) + tuple(out_im_shape),
+                                        dtype=torch.int8, device=device)
+
+        for i in range(num_out_classes):
+            class_idx = i * 2
+            # outputs : (batch_size, bg/fg, depth, height, width)
+            # softmax is monotonic so thresholding the foreground
+            # probability at 0.5 is the same as comparing the logits.
+            predicted = (outputs_on_device[:, class_idx+1] >
+                         outputs_on_device[:, class_idx]).to(torch.int8)
+            # scatter each prediction straight into its final position in
+            # the output volume, still on the device. tiles overlap so
+            # later tiles overwrite earlier ones, as reconstruction did.
+            for b in range(batch_count):
+                x_coord, y_coord, z_coord = coords[batch_start + b]
+                pred_maps_buf[i,
+                              z_coord:z_coord+out_tile_shape[0],
+                              y_coord:y_coord+out_tile_shape[1],
+                              x_coord:x_coord+out_tile_shape[2]] = predicted[b]
+
+        buf_idx = 1 - buf_idx
+        batch_start = next_start
+        batch_count = next_count
+
+    # one device to host copy and one crop for the whole stack, rather
+    # than a python loop with a copy and shape arithmetic per class.
+    pred_maps = pred_maps_buf.cpu().numpy()
+    if padded_for_patch:
+        # go back to the original shape before padding.
+        # what ever we added on to make it as big as the patch size
+        # now take that away.
+        pred_maps = pred_maps[:,
+                              :pred_maps.shape[1] - patch_pad_z,
+                              :pred_maps.shape[2] - patch_pad_y,
+                              :pred_maps.shape[3] - patch_pad_x]
+    return list(pred_maps)
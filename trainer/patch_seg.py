@@ -15,6 +15,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import copy
 import os
 import time
 import torch
@@ -31,7 +32,6 @@ import threading
 import rp_annot as rpa
 from skimage import img_as_float32
 import numpy as np
-from torch.nn.functional import softmax
 from instructions import fix_config_paths
 
 from startup import add_config_shape
@@ -168,21 +168,22 @@ def segment_patch(segment_config, annot_patch, conn):
     if model_path == cached_model_path:
         cnn = cached_model
     else:
-        cnn = load_model(model_path, classes).half()
+        # load_model returns the shared cached model - copy before
+        # halving so other callers keep the fp32 weights.
+        cnn = copy.deepcopy(load_model(model_path, classes)).half()
         cached_model = cnn
         cached_model_path = model_path
-    outputs = cnn(model_input.half())
-    a = outputs.shape
+    with torch.no_grad():
+        outputs = cnn(model_input.half())
     # bg channel index for each class in network output.
     class_idxs = [x * 2 for x in range(outputs.shape[1] // 2)]
     class_output_patches = [[] for _ in class_idxs]
     for i, class_idx in enumerate(class_idxs):
-        # class_output = (batch_size, bg/fg, depth, height, width)
-        class_output = outputs[:, class_idx:class_idx+2]
-        softmaxed = softmax(class_output, 1) 
-        foreground_probs = softmaxed[:, 1]  # just the foreground probability.
-        predicted = foreground_probs > 0.5
-        predicted = predicted.type(torch.cuda.ByteTensor)
+        # outputs = (batch_size, bg/fg, depth, height, width)
+        # softmax is monotonic so thresholding the foreground
+        # probability at 0.5 is the same as comparing the logits.
+        predicted = outputs[:, class_idx+1] > outputs[:, class_idx]
+        predicted = predicted.to(torch.uint8)
         pred_np = predicted.data.detach().cpu().numpy()
         for out_tile in pred_np:
             class_output_patches[i].append(out_tile)
@@ -28,6 +28,7 @@ from datetime import datetime
 import copy
 import random
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 
 import numpy as np
@@ -226,8 +227,11 @@ class Trainer():
 
             model_paths = model_utils.get_latest_model_paths(model_dir, 1)
             if model_paths:
-                self.model = model_utils.load_model(model_paths[0], classes,
-                                                    self.small_unet)
+                # load_model returns a shared cached model, so take a copy
+                # as training updates the weights.
+                self.model = copy.deepcopy(
+                    model_utils.load_model(model_paths[0], classes,
+                                           self.small_unet))
             else:
                 self.model = create_first_model_with_random_weights(
                     model_dir, classes, self.small_unet)
@@ -553,15 +557,39 @@ class Trainer():
 
         start = time.time()
 
+        # check for existing segmentations up front so skipped images
+        # are never read from disk or submitted to the prefetch thread.
+        to_segment = []
         for fname in fnames:
-            self.segment_file(in_dir, seg_dir, fname,
-                              model_paths,
-                              in_w=segment_config['in_w'],
-                              out_w=segment_config['out_w'],
-                              in_d=segment_config['in_d'],
-                              out_d=segment_config['out_d'],
-                              classes=classes,
-                              overwrite=overwrite)
+            if not overwrite and all(os.path.isfile(p) for p in
+                                     self.seg_out_paths(seg_dir, fname, classes)):
+                print(f'Skip because found existing segmentation files for {fname}')
+            else:
+                to_segment.append(fname)
+
+        # load each image on a background thread while the previous one
+        # segments, so the disk read overlaps the GPU work. nibabel and
+        # SimpleITK release the GIL while reading.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            im_future = None
+            if to_segment:
+                im_future = executor.submit(load_image,
+                                            os.path.join(in_dir, to_segment[0]))
+            for i, fname in enumerate(to_segment):
+                next_future = None
+                if i + 1 < len(to_segment):
+                    next_future = executor.submit(
+                        load_image, os.path.join(in_dir, to_segment[i + 1]))
+                self.segment_file(in_dir, seg_dir, fname,
+                                  model_paths,
+                                  in_w=segment_config['in_w'],
+                                  out_w=segment_config['out_w'],
+                                  in_d=segment_config['in_d'],
+                                  out_d=segment_config['out_d'],
+                                  classes=classes,
+                                  overwrite=overwrite,
+                                  im_future=im_future)
+                im_future = next_future
 
         duration = time.time() - start
         print(f'Seconds to segment {len(fnames)} images: ', round(duration, 3))
@@ -622,18 +650,19 @@ class Trainer():
 
         raise Exception('cannot find patch size small enough for image with shape' + str(im.shape))
 
-    def segment_file(self, in_dir, seg_dir, fname, model_paths,
-                     in_w, out_w, in_d, out_d, classes, overwrite=False):
-
+    def seg_out_paths(self, seg_dir, fname, classes):
         # segmentations are always saved as .nii.gz
-        out_paths = []
         if len(classes) > 1:
-            for c in classes:
-                out_fname = fname.replace('.nrrd', '.nii.gz') # output to nii.gz regardless of input format.
-                out_paths.append(os.path.join(seg_dir, c, out_fname))
-        else:
-            # segment to nifty as they don't get loaded repeatedly in training.
-            out_paths = [os.path.join(seg_dir, fname)]
+            out_fname = fname.replace('.nrrd', '.nii.gz') # output to nii.gz regardless of input format.
+            return [os.path.join(seg_dir, c, out_fname) for c in classes]
+        # segment to nifty as they don't get loaded repeatedly in training.
+        return [os.path.join(seg_dir, fname)]
+
+    def segment_file(self, in_dir, seg_dir, fname, model_paths,
+                     in_w, out_w, in_d, out_d, classes, overwrite=False,
+                     im_future=None):
+
+        out_paths = self.seg_out_paths(seg_dir, fname, classes)
 
         if not overwrite and all([os.path.isfile(out_path) for out_path in out_paths]):
             print(f'Skip because found existing segmentation files for {fname}')
@@ -644,7 +673,12 @@ class Trainer():
         if not os.path.isfile(fpath):
             raise Exception(f'Cannot segment as missing file {fpath}')
         try:
-            im = load_image(fpath)
+            if im_future is not None:
+                # image was loaded in the background during the previous
+                # segmentation.
+                im = im_future.result()
+            else:
+                im = load_image(fpath)
             # TODO: Consider removing thie soon
             #im = np.rot90(im, k=3)
             # im = np.moveaxis(im, -1, 0) # depth moved to beginning